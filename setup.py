@@ -26,6 +26,7 @@ setup(
     install_requires=[
       'setuptools',
       'bob >= 1.1.0',
+      'h5py',
     ],
 
     namespace_packages = [
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Converts the database files into memory-mappable NPY files.
+"""
+
+import os
+import sys
+
+# Driver API
+# ==========
+
+def convert(args):
+  """Converts the database files into memory-mappable NPY files"""
+
+  from .query import Database
+  from . import media
+  from bob.db.utils import makedirs_safe
+
+  db = Database()
+
+  output = args.output or args.directory
+  r = db.objects()
+
+  for f in r:
+    source = f.make_path(args.directory, args.extension)
+    target = f.make_path(output, '.npy')
+    if not args.force and \
+        all(os.path.exists(k) for k in media.npy_paths(target).values()):
+      if args.verbose: print "Skipping '%s' (already converted)..." % (target,)
+      continue
+    if args.verbose: print "Converting '%s' into '%s'..." % (source, target)
+    makedirs_safe(os.path.dirname(target))
+    media.convert(source, target, args.chunk)
+
+  return 0
+
+def add_command(subparsers):
+  """Add specific subcommands that the action "convert" can use"""
+
+  parser = subparsers.add_parser('convert', help=convert.__doc__)
+
+  parser.add_argument('-d', '--directory', dest="directory", default='',   help="the directory containing the original HDF5 files (defaults to '%(default)s')")
+  parser.add_argument('-e', '--extension', dest="extension", default='.hdf5', help="the extension of the original files (defaults to '%(default)s')")
+  parser.add_argument('-o', '--output',    dest="output",    default='',   help="the directory where to write the NPY files, load them with File.load(output, '.npy') (defaults to the input directory)")
+  parser.add_argument('-c', '--chunk',     dest="chunk",     default=32,   type=int, help="the number of frames copied at once (defaults to %(default)s)")
+  parser.add_argument('-f', '--force',     dest="force",     default=False, action='store_true', help="if set, files that were already converted are converted again")
+  parser.add_argument('-v', '--verbose',   action='count',   help="print the files as they are converted")
+
+  parser.set_defaults(func=convert) #action
@@ -7,146 +7,437 @@
 """
 
 import os
-import fnmatch
+import sys
 
-from .models import *
+PROTOCOLS = (
+  ('verification', (
+    ('world', 'trainReal', [1, 2]),
+    ('dev', 'enrol', [1]),
+    ('dev', 'probeReal', [2]),
+    ('dev', 'probeMask', [3]),
+    ('test', 'enrol', [1]),
+    ('test', 'probeReal', [2]),
+    ('test', 'probeMask', [3]),
+    )),
+  ('classification', (
+    ('world', 'trainReal', [1, 2]),
+    ('world', 'trainMask', [3]),
+    ('dev', 'classifyReal', [1, 2]),
+    ('dev', 'classifyMask', [3]),
+    ('test', 'classifyReal', [1, 2]),
+    ('test', 'classifyMask', [3]),
+    )),
+  )
+"""The protocols, as pairs of a name and its purposes. Each purpose is a tuple
+(set, purpose, sessions): it gathers the files of the given sessions of the
+clients of that set."""
 
-def add_clients(session, datadir, verbose):
-  """Add clients to the 3d mask attack database."""
+BULK_PRAGMAS = (
+  'PRAGMA synchronous = OFF',
+  'PRAGMA journal_mode = MEMORY',
+  'PRAGMA temp_store = MEMORY',
+  'PRAGMA cache_size = -65536',
+  )
+"""SQLite settings for loading the database in one go: a crash in the middle
+leaves a broken file, but creation is then simply re-run"""
 
+def client_set(id):
+  """Returns the set the client with the given identifier belongs to"""
+
+  if id < 8:
+    return 'world'
+  elif id < 13:
+    return 'dev'
+  else:
+    return 'test'
+
+def add_clients(connection, datadir, verbose):
+  """Add clients to the 3d mask attack database. Returns their sets, keyed by
+  client identifier."""
+
+  from .models import Client
+
+  rows = []
   for id in range(1,18):
-    if id < 8: 
-      set = 'world'
-    elif id < 13:
-      set = 'dev'
-    else:
-      set = 'test'
+    set = client_set(id)
     if verbose: print "Adding client %d on '%s' set..." % (id, set)
-    session.add(Client(id, set))
-
-def add_files(session, datadir, verbose):
-  """Add clients to the 3d mask attack database."""
-
-  for filename in os.listdir(datadir):
-    if filename.endswith('.hdf5'):
-      path, extension = os.path.splitext(filename)
-      tokens = os.path.splitext(path)[0].split('_')
-      client_id = int(tokens[0])
-      session_ = int(tokens[1])
-      shot = int(tokens[2])
-      if verbose: print "Adding filename '%s' ..." % (path,)
-      session.add(File(client_id, path, session_, shot))
-
-def add_protocols(session, verbose):
-  """Adds protocols"""
-
-  protocol_name = 'verification'
-  p = Protocol(protocol_name)
-  # Add protocol
-  if verbose: print "Adding protocol %s..." % (protocol_name)
-  session.add(p)
-  session.flush()
-  session.refresh(p)  
-  
-  # Add protocol purposes
-  protocolPurpose_list = [('world', 'trainReal'), ('dev', 'enrol'), ('dev', 'probeReal'), ('dev', 'probeMask'), ('test', 'enrol'), ('test', 'probeReal'), ('test', 'probeMask')]
-  for key in range(len(protocolPurpose_list)):
-    purpose = protocolPurpose_list[key]
-    
-    # Add files attached with this protocol purpose
-    client_set = ""
-    if(key == 0): 
-      client_set = "world"
-      session_list = [1, 2]
-    elif key in [1,2,3]: 
-      client_set = "dev"
-      session_list = [key]
-    elif key in [4,5,6]: 
-      client_set = "test"
-      session_list = [key-3]
-      
-    pu = ProtocolPurpose(p.id, purpose[0], purpose[1], session_list.__str__())
-    if verbose: print " Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1])
-    session.add(pu)
-    session.flush()
-    session.refresh(pu)
-
-    # Adds 'protocol' files
-    for sid in session_list:
-      q = session.query(File).join(Client).filter(Client.set == client_set).\
-            filter(File.session == sid).order_by(File.id)
-      for k in q:
-        if verbose: print " Adding protocol file '%s'..." % (k.path)
-        #pu.fixfiles.append(k)
-        pu.files.append(k)
-  
-  protocol_name = 'classification'
-  p = Protocol(protocol_name)
-  # Add protocol
-  if verbose: print "Adding protocol %s..." % (protocol_name)
-  session.add(p)
-  session.flush()
-  session.refresh(p)  
-  
-  # Add protocol purposes
-  protocolPurpose_list = [('world', 'trainReal'), ('world', 'trainMask'), ('dev', 'classifyReal'), ('dev', 'classifyMask'), ('test', 'classifyReal'), ('test', 'classifyMask')]
-  for key in range(len(protocolPurpose_list)):
-    purpose = protocolPurpose_list[key]
-
-     # Add files attached with this protocol purpose
-    client_set = ""
-    if(key == 0): 
-      client_set = "world"
-      session_list = [1, 2]
-    elif(key == 1):
-      client_set = "world"
-      session_list = [3]
-    elif(key == 2): 
-      client_set = "dev"
-      session_list = [1, 2]
-    elif(key == 3): 
-      client_set = "dev"
-      session_list = [3]
-    elif(key == 4): 
-      client_set = "test"
-      session_list = [1, 2]
-    elif(key == 5): 
-      client_set = "test"
-      session_list = [3]
-      
-    pu = ProtocolPurpose(p.id, purpose[0], purpose[1], session_list.__str__())
-    if verbose: print " Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1])
-    session.add(pu)
-    session.flush()
-    session.refresh(pu)
-
-    # Adds 'protocol' files
+    rows.append(dict(id=id, set=set))
+  connection.execute(Client.__table__.insert(), rows)
+  return dict((k['id'], k['set']) for k in rows)
+
+def scan(datadir):
+  """Lists the database files in datadir, sorted by name, as (name, size,
+  modification time) tuples. Every database file is stat'ed once for the
+  manifest, which is the main cost of the scan on network file systems;
+  :py:func:`os.scandir`, where available, only saves the stat of the entries
+  that are not database files and tells regular files apart without one."""
+
+  scandir = getattr(os, 'scandir', None)
+  if scandir is not None:
+    entries = [(k.name, k.stat()) for k in scandir(datadir) if k.name.endswith('.hdf5') and k.is_file()]
+  else:
+    entries = [(k, os.stat(os.path.join(datadir, k))) for k in os.listdir(datadir) if k.endswith('.hdf5')]
+  return sorted((k, st.st_size, st.st_mtime) for k, st in entries)
+
+def _check(path):
+  """Pool worker: inspects the header of one file, trapping its errors"""
+
+  from .media import inspect
+  try:
+    return path, inspect(path), None
+  except Exception as e:
+    return path, None, '%s: %s' % (type(e).__name__, e)
+
+def check_files(datadir, filenames, jobs=None):
+  """Checks the HDF5 headers of the given files (see
+  :py:func:`xbob.db.maskattack.media.inspect`) in a pool of processes,
+  reporting progress on the standard error stream.
+
+  Keyword parameters:
+
+  datadir
+    The directory containing the files
+
+  filenames
+    The names of the files to check, inside datadir
+
+  jobs
+    [optional] The number of processes, by default one per CPU. With 1, the
+    files are checked in this process.
+
+  Returns (name, layout) pairs for the valid files, in the given order, with
+  the layout of their streams as returned by
+  :py:func:`xbob.db.maskattack.media.inspect`, and a sorted list of (name,
+  reason) pairs for the others.
+  """
+
+  from multiprocessing import Pool
+
+  paths = [os.path.join(datadir, k) for k in filenames]
+  layouts, errors = {}, {}
+  step = max(1, len(paths) // 10)
+  pool = Pool(jobs) if jobs != 1 and len(paths) > 1 else None
+  try:
+    if pool is None: results = (_check(k) for k in paths)
+    else: results = pool.imap_unordered(_check, paths, chunksize=8)
+    for done, (path, layout, error) in enumerate(results, 1):
+      if error is not None: errors[os.path.basename(path)] = error
+      else: layouts[os.path.basename(path)] = layout
+      if done % step == 0 or done == len(paths):
+        sys.stderr.write("Checked %d of %d files...\n" % (done, len(paths)))
+    if pool is not None: pool.close()
+  except:
+    if pool is not None: pool.terminate()
+    raise
+  finally:
+    if pool is not None: pool.join()
+
+  return [(k, layouts[k]) for k in filenames if k in layouts], sorted(errors.items())
+
+def validate(args, entries):
+  """Checks the given scanned files (see :py:func:`check_files`) unless told
+  not to, ending with a summary of the bad ones. Returns the valid files,
+  with the layout of their streams appended to their entry (``None`` if they
+  were not checked)."""
+
+  if not args.validate or not entries: return [k + (None,) for k in entries]
+
+  good, bad = check_files(args.datadir, [k[0] for k in entries], args.jobs)
+  if bad:
+    sys.stderr.write("%d of %d files are not valid and were left out:\n%s\n" % \
+        (len(bad), len(entries), '\n'.join('  %s: %s' % k for k in bad)))
+  else:
+    sys.stderr.write("All %d files are valid\n" % len(entries))
+  layouts = dict(good)
+  return [k + (layouts[k[0]],) for k in entries if k[0] in layouts]
+
+def media_columns(size, layout):
+  """Returns the media metadata columns of a file, given its size on disk and
+  the layout of its streams (or ``None`` if unknown)"""
+
+  from .media import COLOR, DEPTH
+
+  columns = dict(file_size=size, frames=None, height=None, width=None,
+      color_dtype=None, depth_dtype=None)
+  if layout is not None:
+    (frames, planes, height, width), color_dtype = layout[COLOR]
+    columns.update(frames=frames, height=height, width=width,
+        color_dtype=str(color_dtype), depth_dtype=str(layout[DEPTH][1]))
+  return columns
+
+def add_files(connection, entries, verbose, first_id=1):
+  """Add files to the 3d mask attack database, with their manifest entries.
+  Files are numbered from first_id on, in the given order.
+
+  Keyword parameters:
+
+  connection
+    The connection to insert with
+
+  entries
+    The files to add, as (name, size, modification time, layout) tuples (see
+    :py:func:`validate`)
+
+  first_id
+    [optional] The identifier of the first file
+
+  Returns the inserted file rows.
+  """
+
+  from .models import File, manifest
+
+  rows, stats = [], []
+  for filename, size, mtime, layout in entries:
+    path, extension = os.path.splitext(filename)
+    tokens = path.split('_')
+    if verbose: print "Adding filename '%s' ..." % (path,)
+    row = dict(id=first_id+len(rows), client_id=int(tokens[0]), path=path,
+      session=int(tokens[1]), shot=int(tokens[2]))
+    row.update(media_columns(size, layout))
+    rows.append(row)
+    stats.append(dict(path=path, size=size, mtime=mtime))
+  if rows:
+    connection.execute(File.__table__.insert(), rows)
+    connection.execute(manifest.insert(), stats)
+  return rows
+
+def update_files(connection, entries, verbose):
+  """Records the new size, modification time and media metadata of changed
+  files, given as for :py:func:`add_files`"""
+
+  from sqlalchemy import bindparam
+  from .models import File, manifest
+
+  rows, stats = [], []
+  for filename, size, mtime, layout in entries:
+    path = os.path.splitext(filename)[0]
+    if verbose: print "Updating filename '%s' ..." % (path,)
+    row = media_columns(size, layout)
+    row['_path'] = path
+    rows.append(row)
+    stats.append(dict(path=path, size=size, mtime=mtime))
+  if stats:
+    table = File.__table__
+    connection.execute(table.update().where(table.c.path == bindparam('_path')), rows)
+    # databases created before the manifest have no entry to update
+    connection.execute(manifest.delete().where(manifest.c.path == bindparam('_path')),
+        [dict(_path=k['path']) for k in stats])
+    connection.execute(manifest.insert(), stats)
+
+def remove_files(connection, files, verbose):
+  """Removes files, given as (path, identifier) pairs, along with their
+  manifest entries and protocol memberships"""
+
+  from sqlalchemy import bindparam
+  from .models import File, manifest, protocolPurpose_file_association, protocol_file
+
+  if not files: return
+  if verbose:
+    for path, id in files: print "Removing filename '%s' ..." % (path,)
+  ids = [dict(_id=id) for path, id in files]
+  for table, column in ((protocolPurpose_file_association, 'file_id'),
+      (protocol_file, 'file_id'), (File.__table__, 'id')):
+    connection.execute(table.delete().where(table.c[column] == bindparam('_id')), ids)
+  connection.execute(manifest.delete().where(manifest.c.path == bindparam('_path')),
+      [dict(_path=path) for path, id in files])
+
+def add_protocols(connection, verbose):
+  """Adds the protocols of :py:data:`PROTOCOLS` and their purposes. Returns
+  the purposes as (identifier, sessions) pairs, keyed by (protocol name, set,
+  purpose)."""
+
+  from .models import Protocol, ProtocolPurpose
+
+  protocols, rows, purposes = [], [], {}
+  for protocol_name, protocol_purposes in PROTOCOLS:
+    if verbose: print "Adding protocol %s..." % (protocol_name)
+    protocol_id = len(protocols) + 1
+    protocols.append(dict(id=protocol_id, name=protocol_name))
+
+    for set, purpose, session_list in protocol_purposes:
+      if verbose: print " Adding protocol purpose ('%s','%s')..." % (set, purpose)
+      purpose_id = len(rows) + 1
+      rows.append(dict(id=purpose_id, protocol_id=protocol_id, set=set,
+        purpose=purpose, session_list=str(session_list)))
+      purposes[(protocol_name, set, purpose)] = (purpose_id, session_list)
+
+  connection.execute(Protocol.__table__.insert(), protocols)
+  connection.execute(ProtocolPurpose.__table__.insert(), rows)
+  return purposes
+
+def read_protocols(connection):
+  """Returns the protocol purposes of an existing database, as
+  :py:func:`add_protocols` does"""
+
+  import json
+  from sqlalchemy import select
+  from .models import Protocol, ProtocolPurpose
+
+  q = select([ProtocolPurpose.id, Protocol.name, ProtocolPurpose.set,
+    ProtocolPurpose.purpose, ProtocolPurpose.session_list]).\
+    select_from(ProtocolPurpose.__table__.join(Protocol.__table__))
+  return dict(((p, s, u), (k, json.loads(l))) for k, p, s, u, l in connection.execute(q))
+
+def add_memberships(connection, purposes, clients, files, verbose):
+  """Attaches files to the protocol purposes of their client set and session,
+  in the association and the flattened protocol membership tables
+
+  Keyword parameters:
+
+  connection
+    The connection to insert with
+
+  purposes
+    The protocol purposes, as returned by :py:func:`add_protocols`
+
+  clients
+    The set of each client, keyed by client identifier
+
+  files
+    The file rows, as returned by :py:func:`add_files`
+  """
+
+  from .models import protocolPurpose_file_association, protocol_file
+
+  # file identifiers per (client set, session), in increasing order
+  groups = {}
+  for f in files:
+    groups.setdefault((clients.get(f['client_id']), f['session']), []).append(f['id'])
+
+  associations, memberships = [], []
+  for (protocol_name, set, purpose), (purpose_id, session_list) in \
+      sorted(purposes.items(), key=lambda k: k[1][0]):
     for sid in session_list:
-      q = session.query(File).join(Client).filter(Client.set == client_set).\
-            filter(File.session == sid).order_by(File.id)
-      for k in q:
-        if verbose: print " Adding protocol file '%s'..." % (k.path)
-        #pu.fixfiles.append(k)
-        pu.files.append(k)
+      for file_id in groups.get((set, sid), ()):
+        associations.append({'protocolPurpose_id': purpose_id, 'file_id': file_id})
+        memberships.append(dict(protocol=protocol_name, set=set, purpose=purpose, file_id=file_id))
+
+  if verbose: print "Adding %d protocol files..." % len(associations)
+  if associations:
+    connection.execute(protocolPurpose_file_association.insert(), associations)
+    connection.execute(protocol_file.insert(), memberships)
+
+def fill_protocol_file(connection, verbose):
+  """Fills the flattened protocol membership table in from the association
+  table, for databases created before the former existed. Returns the number
+  of memberships added."""
+
+  from sqlalchemy import select
+  from .models import Protocol, ProtocolPurpose, protocolPurpose_file_association, protocol_file
+
+  association = protocolPurpose_file_association
+  query = select([Protocol.name, ProtocolPurpose.set, ProtocolPurpose.purpose, association.c.file_id]).\
+      where(Protocol.id == ProtocolPurpose.protocol_id).\
+      where(ProtocolPurpose.id == association.c.protocolPurpose_id).\
+      order_by(ProtocolPurpose.id, association.c.file_id)
+  memberships = [dict(protocol=protocol_name, set=set, purpose=purpose, file_id=file_id)
+      for protocol_name, set, purpose, file_id in connection.execute(query)]
+
+  if verbose: print "Filling %d protocol files in..." % len(memberships)
+  if memberships:
+    connection.execute(protocol_file.insert(), memberships)
+  return len(memberships)
 
 def create_tables(args):
-  """Creates all necessary tables (only to be used at the first time)"""
+  """Creates all necessary tables (only to be used at the first time, or to
+  add the tables and columns an older database lacks). Returns the engine to
+  the database."""
 
   from bob.db.utils import create_engine_try_nolock
+  from sqlalchemy.engine.reflection import Inspector
+  from .models import Base, File
 
   engine = create_engine_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
   Base.metadata.create_all(engine)
 
+  # columns added to the file table since, all nullable
+  table = File.__table__
+  present = set(k['name'] for k in Inspector.from_engine(engine).get_columns(table.name))
+  for column in table.columns:
+    if column.name not in present:
+      engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name,
+        column.type.compile(engine.dialect)))
+
+  # indexes added since, which create_all leaves out of existing tables
+  inspector = Inspector.from_engine(engine)
+  for table in Base.metadata.sorted_tables:
+    present = set(k['name'] for k in inspector.get_indexes(table.name))
+    for index in table.indexes:
+      if index.name not in present: index.create(engine)
+  return engine
+
+def update(args):
+  """Brings an existing database up to date with the data directory: files
+  that appeared are added, with their protocol memberships, files that
+  disappeared are removed, with theirs, and the manifest and media metadata
+  of files whose size or modification time changed (or whose media metadata
+  is unknown, when checking files) are refreshed, after checking them again.
+  Everything is done in a single transaction, on the database in place."""
+
+  from sqlalchemy import select, func
+  from .models import Client, File, manifest, protocol_file
+
+  entries = scan(args.datadir)
+  engine = create_tables(args)
+  connection = engine.connect()
+  try:
+    known = dict((p, (k, n)) for p, k, n in
+        connection.execute(select([File.path, File.id, File.frames])))
+    recorded = dict((p, (s, m)) for p, s, m in
+        connection.execute(select([manifest.c.path, manifest.c.size, manifest.c.mtime])))
+
+    added, changed = [], []
+    for entry in entries:
+      path = os.path.splitext(entry[0])[0]
+      if path not in known: added.append(entry)
+      elif recorded.get(path) != entry[1:]: changed.append(entry)
+      elif args.validate and known[path][1] is None: changed.append(entry)
+    scanned = set(os.path.splitext(k[0])[0] for k in entries)
+    removed = [(p, k[0]) for p, k in sorted(known.items()) if p not in scanned]
+
+    valid = dict((k[0], k) for k in validate(args, added + changed))
+    removed += [(os.path.splitext(k[0])[0], known[os.path.splitext(k[0])[0]][0])
+        for k in changed if k[0] not in valid]
+    added = [valid[k[0]] for k in added if k[0] in valid]
+    changed = [valid[k[0]] for k in changed if k[0] in valid]
+
+    transaction = connection.begin()
+    try:
+      # databases created before the flattened protocol membership table get
+      # it empty from create_tables: the memberships of their files go in
+      # first, or these files would be left out of the queries once it is used
+      if connection.execute(select([protocol_file.c.file_id]).limit(1)).first() is None:
+        fill_protocol_file(connection, args.verbose)
+      remove_files(connection, removed, args.verbose)
+      update_files(connection, changed, args.verbose)
+      if added:
+        clients = dict(connection.execute(select([Client.id, Client.set])).fetchall())
+        first_id = (connection.execute(select([func.max(File.id)])).scalar() or 0) + 1
+        files = add_files(connection, added, args.verbose, first_id)
+        add_memberships(connection, read_protocols(connection), clients, files, args.verbose)
+      transaction.commit()
+    except:
+      transaction.rollback()
+      raise
+  finally:
+    connection.close()
+    engine.dispose()
+
+  if args.verbose:
+    print "Added %d, updated %d and removed %d files" % (len(added), len(changed), len(removed))
+  return 0
+
 # Driver API
 # ==========
 
 def create(args):
   """Creates or re-creates this database"""
 
-  from bob.db.utils import session_try_nolock
-
   dbfile = args.files[0]
 
+  if args.update and os.path.exists(dbfile):
+    return update(args)
+
   if args.recreate: 
     if args.verbose and os.path.exists(dbfile):
       print('unlinking %s...' % dbfile)
@@ -155,14 +446,28 @@ def create(args):
   if not os.path.exists(os.path.dirname(dbfile)):
     os.makedirs(os.path.dirname(dbfile))
 
-  # the real work...
-  create_tables(args)
-  s = session_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
-  add_clients(s, args.datadir, args.verbose)
-  add_files(s, args.datadir, args.verbose)
-  add_protocols(s, args.verbose)
-  s.commit()
-  s.close()
+  # the files are looked at before the database is touched
+  entries = validate(args, scan(args.datadir))
+
+  # the real work: all rows are inserted in bulk, in a single transaction
+  engine = create_tables(args)
+  connection = engine.connect()
+  try:
+    if args.type == 'sqlite':
+      for pragma in BULK_PRAGMAS: connection.execute(pragma)
+    transaction = connection.begin()
+    try:
+      clients = add_clients(connection, args.datadir, args.verbose)
+      files = add_files(connection, entries, args.verbose)
+      purposes = add_protocols(connection, args.verbose)
+      add_memberships(connection, purposes, clients, files, args.verbose)
+      transaction.commit()
+    except:
+      transaction.rollback()
+      raise
+  finally:
+    connection.close()
+    engine.dispose()
 
   return 0
   
@@ -171,13 +476,20 @@ def add_command(subparsers):
 
   parser = subparsers.add_parser('create', help=create.__doc__)
 
-  parser.add_argument('-R', '--recreate', action='store_true', default=False,
+  mode = parser.add_mutually_exclusive_group()
+  mode.add_argument('-R', '--recreate', action='store_true', default=False,
       help="If set, I'll first erase the current database")
+  mode.add_argument('-U', '--update', action='store_true', default=False,
+      help="If set, I'll only add, remove and refresh the files that changed in the data directory since the database was created or last updated, in place")
   parser.add_argument('-v', '--verbose', action='count',
       help="Do SQL operations in a verbose way")
   parser.add_argument('-D', '--datadir', action='store', 
       default='/idiap/project/tabularasa/3D Mask Attack/Data',
       metavar='DIR',
       help="Change the relative path to the directory containing the data (defaults to %(default)s)")
+  parser.add_argument('--no-validate', dest='validate', action='store_false', default=True,
+      help="Do not check the HDF5 headers of the files before adding them")
+  parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+      help="Check the files with N processes (defaults to one per CPU)")
   
   parser.set_defaults(func=create) #action
@@ -46,3 +46,7 @@ class Interface(BaseInterface):
     # get the "checkfiles" action from a submodule
     from .checkfiles import add_command as checkfiles_command
     checkfiles_command(subparsers)
+
+    # get the "convert" action from a submodule
+    from .convert import add_command as convert_command
+    convert_command(subparsers)
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Lazy, frame-level access to the color, depth and eye position streams
+stored in the 3D mask attack database HDF5 files
+"""
+
+import numbers
+import numpy
+
+COLOR = 'Color_Data'
+"""Name of the dataset holding the color frames (frames x 3 x 480 x 640)"""
+
+DEPTH = 'Depth_Data'
+"""Name of the dataset holding the depth frames (frames x 480 x 640)"""
+
+EYES = 'Eye_Pos'
+"""Name of the dataset holding the eye positions (frames x 4)"""
+
+NPY = {COLOR: '.color.npy', DEPTH: '.depth.npy', EYES: '.eye.npy'}
+"""Suffixes of the NPY files a database file is converted into, per stream"""
+
+def npy_paths(filename):
+  """Returns the NPY files holding the streams of a converted database file.
+
+  The ``filename`` is the one of the converted file, with a ``.npy``
+  extension, as returned by ``File.make_path(directory, '.npy')``. Returns a
+  dictionary of paths keyed by dataset name.
+  """
+
+  base = filename[:-len('.npy')] if filename.endswith('.npy') else filename
+  return dict((k, base + v) for k, v in NPY.items())
+
+def open_npy(filename, isdepth=True, iseye=True):
+  """Memory-maps the streams of a converted database file.
+
+  Returns the (read-only) color, depth and eye position arrays, with ``None``
+  in place of the streams that were not requested.
+  """
+
+  paths = npy_paths(filename)
+  def _map(key, wanted):
+    return numpy.load(paths[key], mmap_mode='r') if wanted else None
+  return _map(COLOR, True), _map(DEPTH, isdepth), _map(EYES, iseye)
+
+def convert(source, target, chunk=32):
+  """Converts an HDF5 database file into contiguous NPY files.
+
+  The frames are copied ``chunk`` at a time, so memory use does not depend on
+  the length of the video. Each NPY file is written under a temporary name
+  and only renamed once complete.
+
+  Keyword parameters:
+
+  source
+    The HDF5 file to convert
+
+  target
+    The converted filename, with a ``.npy`` extension (see
+    :py:func:`npy_paths`)
+
+  chunk
+    The number of frames copied at once
+  """
+
+  import os
+  from numpy.lib.format import open_memmap
+
+  paths = npy_paths(target)
+  with Video(source) as video:
+    for key, stream in ((COLOR, video.color), (DEPTH, video.depth),
+        (EYES, video.eye_pos)):
+      tmp = paths[key] + '.tmp'
+      out = open_memmap(tmp, mode='w+', dtype=stream.dtype, shape=stream.shape)
+      for start in range(0, len(stream), chunk):
+        out[start:start + chunk] = stream[start:start + chunk]
+      out.flush()
+      del out
+      os.rename(tmp, paths[key])
+
+def pack(color, depth, eye_pos, isdepth, iseye):
+  """Packs the streams in the same way :py:meth:`File.load` returns them"""
+
+  if isdepth and iseye:
+    return (color, depth, eye_pos)
+  elif isdepth:
+    return (color, depth)
+  elif iseye:
+    return (color, eye_pos)
+  else:
+    return color
+
+def load(filename, isdepth=True, iseye=True):
+  """Reads the streams of a database file in full, see :py:meth:`File.load`.
+  Converted files (``.npy``) are memory-mapped instead."""
+
+  if filename.endswith('.npy'):
+    return pack(*(open_npy(filename, isdepth, iseye) + (isdepth, iseye)))
+
+  import bob
+  f = bob.io.HDF5File(filename)
+  color_image = f.read(COLOR)
+  depth_image = f.read(DEPTH) if isdepth else None
+  eye_pos = f.read(EYES) if iseye else None
+  del f
+  return pack(color_image, depth_image, eye_pos, isdepth, iseye)
+
+def load_eyes(filename):
+  """Reads only the eye positions of a database file"""
+
+  if filename.endswith('.npy'):
+    return numpy.load(npy_paths(filename)[EYES])
+
+  import bob
+  return bob.io.HDF5File(filename).read(EYES)
+
+def inspect(filename):
+  """Reads the header of a database file, without its data, checking that it
+  holds the three streams with consistent shapes: the same number of frames,
+  color frames of 3 planes, depth frames of the same size and 4 eye
+  coordinates per frame.
+
+  Returns the (shape, dtype) of each stream, keyed by dataset name. Raises a
+  :py:exc:`ValueError` if a stream is missing or the shapes do not match.
+  """
+
+  import h5py
+  with h5py.File(filename, 'r') as f:
+    layout = {}
+    for key in (COLOR, DEPTH, EYES):
+      if key not in f:
+        raise ValueError("missing dataset '%s'" % key)
+      layout[key] = (f[key].shape, f[key].dtype)
+
+  color, depth, eyes = [layout[k][0] for k in (COLOR, DEPTH, EYES)]
+  if len(color) != 4 or color[1] != 3:
+    raise ValueError("'%s' has shape %s, not (frames, 3, height, width)" % (COLOR, color))
+  if len(depth) != 3 or depth[1:] != color[2:]:
+    raise ValueError("'%s' has shape %s, not (frames, %d, %d)" % ((DEPTH, depth) + color[2:]))
+  if len(eyes) != 2 or eyes[1] != 4:
+    raise ValueError("'%s' has shape %s, not (frames, 4)" % (EYES, eyes))
+  if not color[0] == depth[0] == eyes[0]:
+    raise ValueError("the streams have different numbers of frames (%d, %d and %d)" % \
+        (color[0], depth[0], eyes[0]))
+  return layout
+
+def eye_positions(filenames, cache=None):
+  """Gathers the eye positions of several files, see
+  :py:meth:`Database.eye_positions`.
+
+  Keyword parameters:
+
+  filenames
+    The database files to read the eye positions of
+
+  cache
+    [optional] The path to a sidecar ``.npz`` file where the positions are
+    kept between calls, keyed by the resolved name of the file they were
+    read from, along with its size and modification time. Files found there
+    unchanged are not read again, and the others are added to it.
+  """
+
+  import os
+
+  known = {}
+  if cache and os.path.exists(cache):
+    with numpy.load(cache) as stored:
+      if 'stamps' in stored.files: # older sidecars are rebuilt
+        keys, stamps = stored['keys'], stored['stamps']
+        positions, offsets = stored['positions'], stored['offsets']
+        for i, k in enumerate(keys):
+          known[str(k)] = (tuple(float(v) for v in stamps[i]),
+              positions[offsets[i]:offsets[i+1]])
+
+  blocks = []
+  updated = False
+  for filename in filenames:
+    # converted files keep the eye positions in a stream of their own
+    source = os.path.realpath(npy_paths(filename)[EYES] if filename.endswith('.npy') else filename)
+    try:
+      st = os.stat(source)
+      stamp = (float(st.st_size), float(st.st_mtime))
+    except OSError:
+      stamp = None # not cached, let the load report the error
+    if stamp is None or known.get(source, (None,))[0] != stamp:
+      known[source] = (stamp, numpy.atleast_2d(load_eyes(filename)))
+      updated = True
+    blocks.append(known[source][1])
+
+  offsets = numpy.cumsum([0] + [len(k) for k in blocks])
+  positions = numpy.concatenate(blocks) if blocks else numpy.empty((0, 4))
+
+  if cache and updated:
+    keys = sorted(known)
+    stored = [known[k][1] for k in keys]
+    tmp = cache + '.tmp.npz'
+    numpy.savez(tmp, keys=numpy.array(keys),
+        stamps=numpy.array([known[k][0] for k in keys], dtype='float64'),
+        positions=numpy.concatenate(stored),
+        offsets=numpy.cumsum([0] + [len(k) for k in stored]))
+    os.rename(tmp, cache)
+
+  return positions, offsets
+
+def read(dataset, frames=None, region=()):
+  """Reads the given frames out of an HDF5 dataset, touching only those.
+
+  Keyword parameters:
+
+  dataset
+    An open HDF5 dataset, whose first dimension indexes the frames.
+
+  frames
+    [optional] An integer, a slice or a sequence of frame indexes (or a
+    boolean mask). If ``None``, all frames are read.
+
+  region
+    [optional] A tuple of slices restricting the trailing dimensions of each
+    frame that are read.
+
+  Returns a :py:class:`numpy.ndarray` with the selected frames, in the
+  requested order.
+  """
+
+  region = tuple(region)
+
+  if frames is None:
+    return dataset[(slice(None),) + region] if region else dataset[...]
+
+  if isinstance(frames, numbers.Integral):
+    return dataset[(int(frames),) + region]
+
+  if isinstance(frames, slice):
+    if frames.step is None or frames.step > 0:
+      return dataset[(frames,) + region]
+    # HDF5 hyperslabs cannot run backwards
+    frames = numpy.arange(*frames.indices(len(dataset)))
+
+  frames = numpy.asarray(frames)
+  if frames.dtype == bool:
+    frames = numpy.flatnonzero(frames)
+  frames = numpy.where(frames < 0, frames + len(dataset), frames)
+
+  if not len(frames):
+    return dataset[(slice(0, 0),) + region]
+
+  # HDF5 point selections must be increasing and unique
+  unique, inverse = numpy.unique(frames, return_inverse=True)
+  if unique[-1] - unique[0] + 1 == len(unique):
+    data = dataset[(slice(int(unique[0]), int(unique[-1]) + 1),) + region]
+  else:
+    data = dataset[(unique.tolist(),) + region]
+
+  if len(unique) == len(frames) and (unique == frames).all():
+    return data
+  return data[inverse]
+
+def face_box(eye_pos, height, width):
+  """Computes a face bounding box from eye positions.
+
+  The box spans twice the distance between the eyes horizontally, centered on
+  them, and from one eye distance above to one and a half below them. For
+  several frames, the union of the boxes of all frames is returned, so that
+  all frames can be cropped alike. Frames without detected eyes (all zero
+  positions) are ignored.
+
+  Keyword parameters:
+
+  eye_pos
+    The eye positions, as stored in the ``Eye_Pos`` dataset: one row of
+    (left x, left y, right x, right y) per frame.
+
+  height, width
+    The frame size, to which the box is clipped
+
+  Returns the box as a tuple (top, left, height, width).
+  """
+
+  eye_pos = numpy.atleast_2d(numpy.asarray(eye_pos, dtype=float))
+  eye_pos = eye_pos[(eye_pos != 0).any(axis=1)]
+  if not len(eye_pos):
+    raise ValueError("Cannot compute a face box: no eyes were detected")
+
+  cx = (eye_pos[:,0] + eye_pos[:,2]) / 2.
+  cy = (eye_pos[:,1] + eye_pos[:,3]) / 2.
+  d = numpy.hypot(eye_pos[:,2] - eye_pos[:,0], eye_pos[:,3] - eye_pos[:,1])
+
+  top = max(int(numpy.floor((cy - d).min())), 0)
+  left = max(int(numpy.floor((cx - d).min())), 0)
+  bottom = min(int(numpy.ceil((cy + 1.5 * d).max())), height)
+  right = min(int(numpy.ceil((cx + d).max())), width)
+  return (top, left, max(bottom - top, 0), max(right - left, 0))
+
+class Video(object):
+  """A lazy handle to one of the database videos.
+
+  The underlying HDF5 file is kept open (or the NPY files of a converted file,
+  see :py:func:`convert`, memory-mapped) and nothing is read until the handle
+  is indexed. Indexing works as with a :py:class:`numpy.ndarray` along the
+  frame axis (``video[10]``, ``video[5:20:2]``, ``video[[1, 7, 3]]``) and
+  reads only the selected frames from disk, returning them packed as
+  :py:meth:`File.load` would. The individual streams are also available as
+  the array-like ``color``, ``depth`` and ``eye_pos`` attributes.
+
+  Close the handle when done, or use it as a context manager.
+  """
+
+  def __init__(self, filename, isdepth=True, iseye=True):
+
+    self.filename = filename
+    self.isdepth = isdepth
+    self.iseye = iseye
+
+    if filename.endswith('.npy'):
+      self._file = None
+      streams = open_npy(filename, isdepth, iseye)
+    else:
+      import h5py
+      self._file = h5py.File(filename, 'r')
+      streams = (self._file[COLOR], self._file[DEPTH] if isdepth else None,
+          self._file[EYES] if iseye else None)
+
+    self.color = streams[0]
+    """The color stream (frames x 3 x height x width)"""
+
+    self.depth = streams[1]
+    """The depth stream (frames x height x width) or ``None``"""
+
+    self.eye_pos = streams[2]
+    """The eye positions (frames x 4) or ``None``"""
+
+  def __len__(self):
+    """The number of frames in the video"""
+    return self.color.shape[0]
+
+  def __getitem__(self, frames):
+    """Reads the selected frames of all open streams"""
+
+    return pack(read(self.color, frames),
+        read(self.depth, frames) if self.isdepth else None,
+        read(self.eye_pos, frames) if self.iseye else None,
+        self.isdepth, self.iseye)
+
+  def read(self, frames=None, roi=None):
+    """Reads the selected frames of all open streams, optionally restricted to
+    a region of interest, touching only that part of the files.
+
+    Keyword parameters:
+
+    frames
+      [optional] An integer, a slice or a sequence of frame indexes. If
+      ``None``, all frames are read.
+
+    roi
+      [optional] Either a fixed box as a tuple (top, left, height, width), or
+      ``'face'`` for the box computed by :py:func:`face_box` from the stored
+      eye positions of the selected frames. If ``None``, whole frames are
+      read. The eye positions are returned unchanged, in frame coordinates.
+
+    Returns the data packed as :py:meth:`File.load` does.
+    """
+
+    if roi is None:
+      return self[frames]
+
+    eye_pos = None
+    if roi == 'face':
+      eyes = self.eye_pos if self.eye_pos is not None else self._eyes()
+      eye_pos = read(eyes, frames)
+      roi = face_box(eye_pos, *self.color.shape[-2:])
+    elif self.iseye:
+      eye_pos = read(self.eye_pos, frames)
+
+    top, left, height, width = roi
+    region = (slice(top, top + height), slice(left, left + width))
+    return pack(read(self.color, frames, (slice(None),) + region),
+        read(self.depth, frames, region) if self.isdepth else None,
+        eye_pos, self.isdepth, self.iseye)
+
+  def _eyes(self):
+    """Returns the eye positions, even if they were not requested"""
+
+    if self._file is not None:
+      return self._file[EYES]
+    return numpy.load(npy_paths(self.filename)[EYES], mmap_mode='r')
+
+  def chunks(self, size):
+    """Yields consecutive windows of ``size`` frames (the last one may be
+    shorter), reading each of them only when requested"""
+
+    if size < 1:
+      raise ValueError("The chunk size must be positive, not %d" % size)
+    for start in range(0, len(self), size):
+      yield self[start:start + size]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def __repr__(self):
+    return "Video('%s')" % self.filename
+
+  def close(self):
+    """Closes the underlying HDF5 file"""
+
+    self.color = self.depth = self.eye_pos = None
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+class LoadError(RuntimeError):
+  """Raised when some files of a batch could not be loaded.
+
+  The ``failures`` attribute lists ``(filename, message)`` pairs for every
+  file that failed, while ``results`` keeps what could be loaded: either the
+  list of loaded data in order, with ``None`` in place of the failed files,
+  or the partially filled stacked arrays (``None`` if no file could be read).
+  """
+
+  def __init__(self, failures, results):
+    self.failures = failures
+    self.results = results
+    RuntimeError.__init__(self, '%d file(s) could not be loaded:\n%s' % \
+        (len(failures), '\n'.join('  %s: %s' % k for k in failures)))
+
+def _load_indexed(args):
+  """Pool worker: loads one file, trapping its errors"""
+
+  index, filename, isdepth, iseye = args
+  try:
+    return (index, load(filename, isdepth, iseye), None)
+  except Exception as e:
+    return (index, None, '%s: %s' % (type(e).__name__, e))
+
+def _stream_layout(filename, isdepth, iseye):
+  """Returns the (shape, dtype) of each requested stream of a file"""
+
+  with Video(filename, isdepth, iseye) as v:
+    streams = [v.color, v.depth, v.eye_pos]
+    return [(k.shape, k.dtype) if k is not None else None for k in streams]
+
+def load_many(filenames, isdepth=True, iseye=True, workers=4, processes=False,
+    stack=False):
+  """Loads several files concurrently, see :py:meth:`Database.load_objects`"""
+
+  if workers < 1:
+    raise ValueError("The number of workers must be positive, not %d" % workers)
+
+  from multiprocessing import Pool
+  from multiprocessing.pool import ThreadPool
+
+  filenames = list(filenames)
+  nstreams = 1 + int(bool(isdepth)) + int(bool(iseye))
+  results = [None] * len(filenames)
+  failures = {}
+
+  outputs = None
+  if stack:
+    if not filenames:
+      raise ValueError("Cannot stack an empty list of files")
+    # preallocates the output, so every file is copied in place once read,
+    # taking the layout of the first file whose header can be read
+    for index, filename in enumerate(filenames):
+      try:
+        layout = [k for k in _stream_layout(filename, isdepth, iseye) if k]
+      except Exception as e:
+        failures[index] = '%s: %s' % (type(e).__name__, e)
+        continue
+      outputs = [numpy.empty((len(filenames),) + s, dtype=d) for s, d in layout]
+      break
+    if outputs is None:
+      raise LoadError([(filenames[k], failures[k]) for k in sorted(failures)], None)
+
+  pool = (Pool if processes else ThreadPool)(min(workers, max(len(filenames), 1)))
+  try:
+    jobs = [(i, k, isdepth, iseye) for i, k in enumerate(filenames) if i not in failures]
+    for index, data, error in pool.imap_unordered(_load_indexed, jobs):
+      if error is not None:
+        failures[index] = error
+        continue
+      if outputs is None:
+        results[index] = data
+        continue
+      streams = data if nstreams > 1 else (data,)
+      for out, k in zip(outputs, streams):
+        if out.shape[1:] != k.shape:
+          failures[index] = 'ValueError: cannot stack shape %s with %s' % \
+              (k.shape, out.shape[1:])
+          break
+        out[index] = k
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+  if outputs is not None:
+    results = outputs[0] if nstreams == 1 else tuple(outputs)
+
+  if failures:
+    raise LoadError([(filenames[k], failures[k]) for k in sorted(failures)],
+        results)
+
+  return results
+
+class LoadCache(object):
+  """An in-process, least-recently-used cache of loaded data, bounded by the
+  total size of the arrays it holds.
+
+  Install one with ``File.cache = LoadCache(budget)`` to have repeated
+  :py:meth:`File.load` calls served from memory. Cached arrays are made
+  read-only, as they are shared between all callers.
+
+  Keyword parameters:
+
+  budget
+    The maximum number of bytes held by the cache. Data larger than this is
+    never cached.
+  """
+
+  def __init__(self, budget):
+
+    import threading
+    from collections import OrderedDict
+    if budget < 0:
+      raise ValueError("The cache budget cannot be negative, not %d" % budget)
+    self.budget = budget
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __repr__(self):
+    return "LoadCache(%d/%d bytes, %d entries, %d hits, %d misses)" % \
+        (self.nbytes, self.budget, len(self), self.hits, self.misses)
+
+  @staticmethod
+  def _arrays(data):
+    return data if isinstance(data, tuple) else (data,)
+
+  def get(self, key):
+    """Returns the data cached for the given key, or ``None``"""
+
+    with self._lock:
+      data = self._entries.pop(key, None)
+      if data is None:
+        self.misses += 1
+        return None
+      self._entries[key] = data # most recently used
+      self.hits += 1
+      return data
+
+  def put(self, key, data):
+    """Caches the given data, evicting the least recently used entries as
+    needed to stay within the budget. Returns the (now read-only) data."""
+
+    arrays = self._arrays(data)
+    for k in arrays: k.setflags(write=False)
+    size = sum(k.nbytes for k in arrays)
+    if size > self.budget: return data
+
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.nbytes -= sum(k.nbytes for k in self._arrays(old))
+      while self._entries and self.nbytes + size > self.budget:
+        evicted = self._entries.popitem(last=False)[1]
+        self.nbytes -= sum(k.nbytes for k in self._arrays(evicted))
+      self._entries[key] = data
+      self.nbytes += size
+    return data
+
+  def clear(self):
+    """Empties the cache and resets its counters"""
+
+    with self._lock:
+      self._entries.clear()
+      self.nbytes = self.hits = self.misses = 0
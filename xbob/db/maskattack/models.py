@@ -7,13 +7,12 @@
 """
 
 import os
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, or_, and_, not_
+from sqlalchemy import Table, Column, Integer, Float, String, ForeignKey, Index, or_, and_, not_
 from bob.db.sqlalchemy_migration import Enum, relationship
-import bob.db.utils
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import backref, deferred
 from sqlalchemy.ext.declarative import declarative_base
 import numpy
-import bob
+from . import media
 
 Base = declarative_base()
 #protocolPurpose_file_association_fix = Table('protocolPurpose_file_association_fix', Base.metadata,
@@ -21,7 +20,30 @@ Base = declarative_base()
 #  Column('file_id', Integer, ForeignKey('file.id')))
 protocolPurpose_file_association = Table('protocolPurpose_file_association', Base.metadata,
   Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id')),
-  Column('file_id', Integer, ForeignKey('file.id')))
+  Column('file_id', Integer, ForeignKey('file.id')),
+  Index('protocolPurpose_file_purpose_file', 'protocolPurpose_id', 'file_id'),
+  Index('protocolPurpose_file_file', 'file_id'))
+
+protocol_file = Table('protocol_file', Base.metadata,
+  Column('protocol', String(20)),
+  Column('set', String(20)),
+  Column('purpose', String(20)),
+  Column('file_id', Integer, ForeignKey('file.id')),
+  Index('protocol_file_membership', 'protocol', 'set', 'purpose', 'file_id'))
+"""The protocol memberships of the files, flattened: one row per (protocol name,
+set, purpose, file identifier), as the association of the files to the protocol
+purposes stands for. This is filled by ``create``, and lets
+:py:meth:`Database.objects` select files without joining the protocol tables.
+Databases created before it existed do not have it, and are queried through
+the joins."""
+
+manifest = Table('manifest', Base.metadata,
+  Column('path', String(100), primary_key=True),
+  Column('size', Integer),
+  Column('mtime', Float))
+"""The size and modification time of the data file of each :py:class:`File`,
+keyed by path, as they were when the file was added. ``create --update``
+compares them with the data directory to find the files that changed."""
 
 class Client(Base):
   """Database clients, marked by an integer identifier and the set they belong to"""
@@ -49,44 +71,38 @@ class Client(Base):
     #return "Client('%s', '%s', '%s')" % (self.id, self.set, self.fixset)
     return "Client('%s', '%s'')" % (self.id, self.set)
 
-class File(Base):
-  """Generic file container"""
+class FileMixin(object):
+  """The path, data access and media metadata methods of :py:class:`File`
+  and :py:class:`FileDescriptor`, which only rely on their ``path`` and
+  media metadata columns"""
 
-  __tablename__ = 'file'
+  media_columns = ('frames', 'height', 'width', 'color_dtype', 'depth_dtype', 'file_size')
+  """The names of the media metadata columns"""
 
-  #session_choices = (1, 2)
-  """List of sessions """
+  @property
+  def color_shape(self):
+    """The shape of the color stream (frames x 3 x height x width), or
+    ``None`` if unknown"""
 
-  #shot_choices = (1, 2, 3, 4, 5)
-  """List of shots """
+    if self.frames is None: return None
+    return (self.frames, 3, self.height, self.width)
 
-  id = Column(Integer, primary_key=True)
-  """Key identifier for files"""
+  @property
+  def depth_shape(self):
+    """The shape of the depth stream (frames x height x width), or ``None``
+    if unknown"""
 
-  client_id = Column(Integer, ForeignKey('client.id')) # for SQL
-  """The client identifier to which this file is bound to"""
+    if self.frames is None: return None
+    return (self.frames, self.height, self.width)
 
-  path = Column(String(100), unique=True)
-  """The (unique) path to this file inside the database"""
+  @property
+  def nbytes(self):
+    """The memory taken by the color and depth streams once loaded, in bytes,
+    or ``None`` if unknown"""
 
-  session = Column(Integer)
-  """The session identifier in which the data for this file was taken"""
-
-  shot = Column(Integer)
-  """The shot identifier in which the data for this file was taken"""
-
-  # for Python
-  client = relationship(Client, backref=backref('files', order_by=id))
-  """A direct link to the client object that this file belongs to"""
-
-  def __init__(self, client_id, path, session, shot):
-    self.client_id = client_id
-    self.path = path
-    self.session = session
-    self.shot = shot
-
-  def __repr__(self):
-    return "File('%s')" % self.path
+    if self.frames is None: return None
+    return int(numpy.prod(self.color_shape)) * numpy.dtype(str(self.color_dtype)).itemsize + \
+        int(numpy.prod(self.depth_shape)) * numpy.dtype(str(self.depth_dtype)).itemsize
 
   def make_path(self, directory=None, extension='.hdf5'):
     """Wraps the current path so that a complete path is formed
@@ -109,37 +125,192 @@ class File(Base):
 
     return str(os.path.join(directory, self.path + extension))
 
-  def load(self, directory=None, extension='.hdf5', isdepth=True, iseye=True):
+  def load(self, directory=None, extension='.hdf5', isdepth=True, iseye=True,
+      frames=None, roi=None):
     """Loads the data at the specified location and using the given extension.
 
     Keyword parameters:
 
-    data
-      The data blob to be saved (normally a :py:class:`numpy.ndarray`).
+    directory
+      [optional] If not empty or None, this directory is prefixed to the final
+      file destination
+
+    extension
+      [optional] The extension of the filename. Files converted with the
+      ``convert`` command are loaded with ``.npy``, in which case the returned
+      arrays are read-only memory maps of the converted files.
+
+    isdepth
+      [optional] If set, the depth stream is also returned
+
+    iseye
+      [optional] If set, the eye positions are also returned
+
+    frames
+      [optional] An integer, a slice or a sequence of frame indexes to load.
+      If ``None``, all frames are loaded.
+
+    roi
+      [optional] The region of the color and depth frames to load, either as
+      a fixed box (top, left, height, width) or as ``'face'``, for a face box
+      computed from the stored eye positions of the loaded frames (see
+      :py:func:`xbob.db.maskattack.media.face_box`). If ``None``, whole frames
+      are loaded.
+
+    Only the selected frames and regions are read from disk. Returns the color
+    stream, followed by the depth stream and eye positions if requested, in a
+    tuple. If :py:attr:`File.cache` is set, the returned arrays are read-only.
+    """
+    if frames is not None or roi is not None:
+      with self.open(directory, extension, isdepth, iseye) as video:
+        return video.read(frames, roi)
+
+    cache = File.cache
+    if cache is None:
+      return media.load(self.make_path(directory, extension), isdepth, iseye)
+
+    key = (self.path, directory, extension, isdepth, iseye)
+    data = cache.get(key)
+    if data is None:
+      data = cache.put(key,
+          media.load(self.make_path(directory, extension), isdepth, iseye))
+    return data
+
+  def open(self, directory=None, extension='.hdf5', isdepth=True, iseye=True):
+    """Opens the data at the specified location for lazy, per-frame access.
+
+    Nothing is read until the returned handle is indexed, so memory scales
+    with the frames that are actually used, not with the length of the video.
+
+    Keyword parameters:
 
     directory
       [optional] If not empty or None, this directory is prefixed to the final
       file destination
 
     extension
-      [optional] The extension of the filename - this will control the type of
-      output and the codec for saving the input blob.
+      [optional] The extension of the filename
+
+    isdepth
+      [optional] If set, the depth stream is also returned when indexing
+
+    iseye
+      [optional] If set, the eye positions are also returned when indexing
+
+    Returns a :py:class:`xbob.db.maskattack.media.Video`, that should be closed
+    after use.
+    """
+
+    return media.Video(self.make_path(directory, extension), isdepth, iseye)
+
+  def iter_frames(self, chunk=1, directory=None, extension='.hdf5',
+      isdepth=True, iseye=True):
+    """Iterates over the data at the specified location, ``chunk`` frames at a
+    time.
+
+    Only one window of frames is held in memory at any time, no matter how
+    long the video is.
+
+    Keyword parameters:
+
+    chunk
+      [optional] The number of frames in each window. The last window may be
+      shorter.
+
+    directory
+      [optional] If not empty or None, this directory is prefixed to the final
+      file destination
+
+    extension
+      [optional] The extension of the filename
+
+    isdepth, iseye
+      [optional] Which streams to return, as in :py:meth:`load`
+
+    Yields the windows packed as :py:meth:`load` returns them.
     """
-    f =  bob.io.HDF5File(self.make_path(directory, extension))    
-    color_image = f.read('Color_Data')
-    if isdepth:
-        depth_image = f.read('Depth_Data')
-    if iseye:
-        eye_pos = f.read('Eye_Pos')
-    del f
-    if isdepth and iseye:
-        return (color_image, depth_image, eye_pos)
-    elif isdepth:
-        return (color_image, depth_image)
-    elif iseye:
-        return (color_image, eye_pos)
-    else:
-        return color_image
+
+    with self.open(directory, extension, isdepth, iseye) as video:
+      for window in video.chunks(chunk):
+        yield window
+
+class File(Base, FileMixin):
+  """Generic file container"""
+
+  __tablename__ = 'file'
+  __table_args__ = (Index('file_client_session_shot', 'client_id', 'session', 'shot'),)
+
+  #session_choices = (1, 2)
+  """List of sessions """
+
+  #shot_choices = (1, 2, 3, 4, 5)
+  """List of shots """
+
+  id = Column(Integer, primary_key=True)
+  """Key identifier for files"""
+
+  client_id = Column(Integer, ForeignKey('client.id')) # for SQL
+  """The client identifier to which this file is bound to"""
+
+  path = Column(String(100), unique=True)
+  """The (unique) path to this file inside the database"""
+
+  session = Column(Integer)
+  """The session identifier in which the data for this file was taken"""
+
+  shot = Column(Integer)
+  """The shot identifier in which the data for this file was taken"""
+
+  # media metadata, read from the file headers by create (``None`` if the
+  # files were not checked). These columns are deferred, as databases created
+  # before they existed lack them: they are loaded along by the queries of
+  # Database where present, and on first access otherwise, which fails on
+  # such databases (update them with ``create --update``).
+  frames = deferred(Column(Integer), group='media')
+  """The number of frames of the video"""
+
+  height = deferred(Column(Integer), group='media')
+  """The height of the color and depth frames, in pixels"""
+
+  width = deferred(Column(Integer), group='media')
+  """The width of the color and depth frames, in pixels"""
+
+  color_dtype = deferred(Column(String(10)), group='media')
+  """The data type of the color stream, as a :py:class:`numpy.dtype` name"""
+
+  depth_dtype = deferred(Column(String(10)), group='media')
+  """The data type of the depth stream, as a :py:class:`numpy.dtype` name"""
+
+  file_size = deferred(Column(Integer), group='media')
+  """The size of the data file on disk, in bytes"""
+
+  # for Python
+  client = relationship(Client, backref=backref('files', order_by=id))
+  """A direct link to the client object that this file belongs to"""
+
+  cache = None
+  """An optional :py:class:`xbob.db.maskattack.media.LoadCache` serving
+  repeated :py:meth:`load` calls from memory (disabled if ``None``)"""
+
+  def __init__(self, client_id, path, session, shot):
+    self.client_id = client_id
+    self.path = path
+    self.session = session
+    self.shot = shot
+
+  def __repr__(self):
+    return "File('%s')" % self.path
+
+  def descriptor(self):
+    """Returns a detached, picklable :py:class:`FileDescriptor` of this file.
+    Media metadata columns that were not loaded with it (see
+    :py:meth:`xbob.db.maskattack.Database.has_media_metadata`) are ``None``
+    in the descriptor."""
+
+    from sqlalchemy.orm.attributes import instance_state
+    unloaded = instance_state(self).unloaded # not loading what may be missing
+    return FileDescriptor(self.id, self.client_id, self.path, self.session,
+        self.shot, **dict((k, getattr(self, k)) for k in self.media_columns if k not in unloaded))
 
   def save(self, data, directory=None, extension='.hdf5'):
     """Saves the input data at the specified location and using the given
@@ -159,10 +330,31 @@ class File(Base):
       output and the codec for saving the input blob.
     """
 
+    import bob
+    from bob.db.utils import makedirs_safe
     path = self.make_path(directory, extension)
-    bob.db.utils.makedirs_safe(os.path.dirname(path))
+    makedirs_safe(os.path.dirname(path))
     bob.io.save(data, path)
 
+class FileDescriptor(FileMixin):
+  """A detached copy of a :py:class:`File`, holding only its columns.
+
+  Unlike :py:class:`File` objects, which are bound to the database session,
+  descriptors pickle cleanly and can be shipped to worker processes. They
+  provide the same data access methods as :py:class:`File`.
+  """
+
+  def __init__(self, id, client_id, path, session, shot, **columns):
+    self.id = id
+    self.client_id = client_id
+    self.path = path
+    self.session = session
+    self.shot = shot
+    for k in self.media_columns: setattr(self, k, columns.get(k))
+
+  def __repr__(self):
+    return "FileDescriptor('%s')" % self.path
+
 class Protocol(Base):
   """Mask attack protocol"""
 
@@ -9,15 +9,129 @@ replay attack database in the most obvious ways.
 
 import os
 import logging
+import threading
+from collections import OrderedDict
 from bob.db import utils
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, joinedload_all, undefer_group
 from .models import *
 from .driver import Interface
+from . import media
+import numpy
 from numpy import random
 
 INFO = Interface()
 
+FILE_METADATA = [('id', 'int64'), ('client_id', 'int32'), ('session', 'int32'),
+    ('shot', 'int32'), ('set', 'S5'), ('path_index', 'int64'),
+    ('frames', 'int32'), ('file_size', 'int64')]
+"""The fields of the arrays returned by :py:meth:`Database.file_metadata`"""
+
+OBJECTS_TABLE = [('protocol', 'S20'), ('file_id', 'int64'),
+    ('client_id', 'int32'), ('session', 'int32'), ('shot', 'int32'),
+    ('set', 'S5'), ('purpose', 'S12'), ('is_mask', 'bool')]
+"""The fields of the arrays returned by :py:meth:`Database.objects_table`"""
+
 SQLITE_FILE = INFO.files()[0]
 
+_read_only_engines = {}
+_read_only_lock = threading.Lock()
+
+def _sqlite_uses_uri():
+  """Returns if the SQLite library takes ``file:`` filenames as URIs even when
+  not asked to, as it does if compiled with ``SQLITE_USE_URI``. This is the
+  only way to pass URI parameters where :py:func:`sqlite3.connect` has no
+  ``uri`` argument, as on Python 2."""
+
+  import sqlite3
+  connection = sqlite3.connect(':memory:')
+  try:
+    return 'USE_URI' in [k[0] for k in connection.execute('PRAGMA compile_options')]
+  finally:
+    connection.close()
+
+def _connect_read_only():
+  """Opens a read-only connection to the database file, declared immutable so
+  that SQLite skips all file locking. Raises a RuntimeError if this Python
+  and SQLite cannot open it so."""
+
+  import sqlite3
+  try:
+    from urllib import pathname2url
+  except ImportError:
+    from urllib.request import pathname2url
+
+  uri = 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(SQLITE_FILE))
+  try:
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+  except TypeError: # no uri argument, before Python 3.4
+    pass
+  if _sqlite_uses_uri():
+    return sqlite3.connect(uri, check_same_thread=False)
+  # an ordinary connection would still lock the file, defeating the purpose
+  raise RuntimeError, "Cannot open database '%s' read-only without locking: this Python cannot pass URI filenames to SQLite %s, which was not compiled with SQLITE_USE_URI. Open it with read_only=False instead." % (SQLITE_FILE, sqlite3.sqlite_version)
+
+def read_only_engine():
+  """Returns the engine reading the database in read-only mode.
+
+  There is one such engine per process, keeping a pool of read-only,
+  immutable connections that are reused by all read-only
+  :py:class:`Database` objects of that process. The pool does not limit the
+  number of connections, as each session (or each thread, in thread-safe mode)
+  holds one while open.
+  """
+
+  key = (os.getpid(), SQLITE_FILE)
+  with _read_only_lock:
+    engine = _read_only_engines.get(key)
+    if engine is None:
+      _connect_read_only().close() # fails early if immutable mode is missing
+      from sqlalchemy import create_engine
+      from sqlalchemy.pool import QueuePool
+      engine = create_engine('sqlite://', creator=_connect_read_only,
+          poolclass=QueuePool, pool_size=5, max_overflow=-1)
+      _read_only_engines[key] = engine
+    return engine
+
+class _Caches(object):
+  """The ORM objects a :py:class:`Database` keeps: its snapshot and the
+  results of :py:meth:`Database.objects`"""
+
+  def __init__(self):
+    self.snapshot = None
+    self.objects = OrderedDict()
+
+class _ThreadCaches(threading.local):
+  """As :py:class:`_Caches`, one per thread: ORM objects belong to the session
+  that loaded them, and each thread of a thread-safe database has its own"""
+
+  def __init__(self):
+    self.snapshot = None
+    self.objects = OrderedDict()
+
+def _map_file(args):
+  """Pool worker for :py:meth:`Database.map`: loads one file and applies the
+  user function to its data, retrying on failure"""
+
+  fn, descriptor, retries, load_args = args
+  for attempt in range(retries + 1):
+    try:
+      return fn(descriptor.load(*load_args))
+    except Exception as e:
+      error = '%s: %s' % (type(e).__name__, e)
+  raise RuntimeError("Processing '%s' failed after %d attempt(s): %s" % \
+      (descriptor.path, retries + 1, error))
+
+def _imap(pool, results):
+  """Yields the results of a pool, releasing it once done"""
+
+  try:
+    for k in results: yield k
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
 class Database(object):
   """The dataset class opens and maintains a connection opened to the Database.
 
@@ -25,22 +139,136 @@ class Database(object):
   and for the data itself inside the database.
   """
 
-  def __init__(self):
-    # opens a session to the database - keep it open until the end
-    self.connect()
+  def __init__(self, snapshot=False, cache_size=0, read_only=False,
+      thread_safe=False):
+    """Opens the database.
+
+    Keyword Parameters:
+
+    snapshot
+    If set, the metadata of the whole database is loaded in memory on first
+    use (see :py:meth:`snapshot`), and :py:meth:`objects`,
+    :py:meth:`clients` and :py:meth:`protocols` are answered from there,
+    without SQL.
+
+    cache_size
+    If positive, the results of the last ``cache_size`` distinct queries to
+    :py:meth:`objects` are kept, and repeated queries are answered from there.
+    Results are then returned as tuples, so they cannot be modified.
+
+    read_only
+    If set, the database file is opened read-only and immutable, so SQLite
+    never locks it, and connections are taken from a pool shared by all
+    read-only databases of the process (see :py:func:`read_only_engine`).
+    Use this when many jobs read the same installed database at once.
+
+    thread_safe
+    If set, the database can be queried from several threads at once: each
+    thread gets its own session (see :py:attr:`session`), and its own snapshot
+    and cached :py:meth:`objects` results, bound to that session.
+
+    The connection is re-opened transparently in processes forked after it was
+    opened, and pickling a database only keeps these parameters, so it can be
+    sent to the workers of a :py:class:`multiprocessing.Pool` cheaply.
+    """
+    self._setup(snapshot, cache_size, read_only, thread_safe)
     random.seed(42)
 
+  def _setup(self, snapshot, cache_size, read_only, thread_safe):
+    """Sets the parameters up, leaving the connection to be opened on use"""
+    if cache_size < 0:
+      raise ValueError("The cache size cannot be negative, not %d" % cache_size)
+    self.use_snapshot = snapshot
+    self.cache_size = cache_size
+    self.read_only = read_only
+    self.thread_safe = thread_safe
+    self._lock = threading.RLock()
+    # the session to the database is only opened on first use (see session),
+    # then kept open until the end
+    self._session = None
+    self._connected = False
+    self._reset_caches()
+
+  def __getstate__(self):
+    """Only the parameters are pickled, the connection is re-opened on use"""
+    return dict(snapshot=self.use_snapshot, cache_size=self.cache_size,
+        read_only=self.read_only, thread_safe=self.thread_safe)
+
+  def __setstate__(self, state):
+    """Unpickles without seeding the random number generator again, which
+    would reset the one of the unpickling process"""
+    self._setup(**state)
+
   def __del__(self):
     """Releases the opened file descriptor"""
-    if self.session: self.session.bind.dispose()
+    if getattr(self, '_session', None):
+      engine = self._session.bind
+      if self.thread_safe: self._session.remove()
+      else: self._session.close()
+      if not self.read_only: engine.dispose() # the read-only engine is shared
+
+  @property
+  def session(self):
+    """The session to the database, opened on first use (``None`` if the
+    database file does not exist). In thread-safe mode, this is a
+    :py:func:`sqlalchemy.orm.scoped_session`, standing for a different
+    session in each thread."""
+    self._check_connection()
+    return self._session
+
+  def _check_connection(self):
+    """Connects on first use, and again in processes forked after the
+    connection was opened"""
+    if not self._connected or self._pid != os.getpid():
+      with self._lock:
+        if not self._connected: self.connect()
+        elif self._pid != os.getpid():
+          # this process was forked from the one that opened the connection,
+          # which cannot be shared: the inherited session is left alone (not
+          # closed, as it still belongs to the parent) and a new one is opened
+          self._session = None
+          self.connect()
+
+  def _reset_caches(self):
+    """Drops everything read from the database so far"""
+    self._caches = _ThreadCaches() if self.thread_safe else _Caches()
+    self._file_table = None
+    self._vocabularies = None
+    self._flattened = None
+    self._media = None
 
   def connect(self):
     """Tries connecting or re-connecting to the database"""
-    if not os.path.exists(SQLITE_FILE):
-      self.session = None
+    with self._lock:
+      self._reset_caches()
+      self._connected = True
+      self._pid = os.getpid()
+      if not os.path.exists(SQLITE_FILE):
+        self._session = None
+
+      elif self.read_only or self.thread_safe:
+        from sqlalchemy.orm import sessionmaker, scoped_session
+        if self.read_only:
+          engine = read_only_engine()
+        else:
+          engine = utils.create_engine_try_nolock(INFO.type(), SQLITE_FILE)
+        factory = sessionmaker(bind=engine)
+        self._session = scoped_session(factory) if self.thread_safe else factory()
 
-    else:
-      self.session = utils.session(INFO.type(), SQLITE_FILE) #DOES NOT TRY READ ONLY FIRST, LOCK SHOULD BE WORKING - GLOBALLY!!! (unlike temp)
+      else:
+        self._session = utils.session(INFO.type(), SQLITE_FILE) #DOES NOT TRY READ ONLY FIRST, LOCK SHOULD BE WORKING - GLOBALLY!!! (unlike temp)
+
+  def snapshot(self):
+    """Returns the in-memory :py:class:`xbob.db.maskattack.snapshot.Snapshot`
+    of the database metadata, taking it on first use"""
+
+    self.assert_validity()
+    with self._lock:
+      caches = self._caches
+      if caches.snapshot is None:
+        from .snapshot import Snapshot
+        caches.snapshot = Snapshot(self.session, self.has_media_metadata())
+      return caches.snapshot
 
   def is_valid(self):
     """Returns if a valid session has been opened for reading the database"""
@@ -81,7 +309,7 @@ class Database(object):
     This will be used to raise an exception in case the parameter is not valid.
 
     valid_parameters
-    A list/tuple of valid values for the parameters.
+    A list/tuple (or a set, for faster checks) of valid values for the parameters.
 
     default_parameters
     The list/tuple of default parameters that will be returned in case parameters is None or empty.
@@ -98,11 +326,65 @@ class Database(object):
     # perform the checks
     for parameter in parameters:
       if parameter not in valid_parameters:
+        if isinstance(valid_parameters, (set, frozenset)): valid_parameters = sorted(valid_parameters)
         raise ValueError, "Invalid %s '%s'. Valid values are %s, or lists/tuples of those" % (parameter_description, parameter, valid_parameters)
 
     # check passed, now return the list/tuple of parameters
     return parameters
 
+  def _vocabulary(self, name):
+    """Returns the valid values of the given parameter of :py:meth:`objects`
+    ('protocol', 'purpose', 'set', 'class' or 'client_id'), as a frozenset
+    for fast checks and as a tuple of defaults. These are read from the
+    database once, and again after :py:meth:`connect`."""
+
+    if self._vocabularies is None:
+      with self._lock:
+        if self._vocabularies is None:
+          self.assert_validity()
+          clients = tuple(k for (k,) in self.session.query(Client.id).order_by(Client.id))
+          values = dict(protocol=tuple(self.protocol_names()), purpose=self.purposes(),
+              set=self.sets(), client_id=clients)
+          values['class'] = ('client', 'impostor')
+          self._vocabularies = dict((k, (frozenset(v), v)) for k, v in values.items())
+    return self._vocabularies[name]
+
+  def has_protocol_file(self):
+    """Returns if the database has a filled flattened protocol membership
+    table (see :py:data:`xbob.db.maskattack.models.protocol_file`), which
+    databases created by older versions of this package lack. This is checked
+    once, and again after :py:meth:`connect`."""
+
+    if self._flattened is None:
+      with self._lock:
+        if self._flattened is None:
+          self.assert_validity()
+          from sqlalchemy.exc import OperationalError
+          try:
+            row = self.session.execute(select([protocol_file.c.file_id]).limit(1)).first()
+            self._flattened = row is not None
+          except OperationalError: # no such table
+            self._flattened = False
+    return self._flattened
+
+  def has_media_metadata(self):
+    """Returns if the file table of the database has the media metadata
+    columns (see :py:class:`File`), which databases created by older versions
+    of this package lack. This is checked once, and again after
+    :py:meth:`connect`."""
+
+    if self._media is None:
+      with self._lock:
+        if self._media is None:
+          self.assert_validity()
+          from sqlalchemy.exc import OperationalError
+          try:
+            self.session.execute(select([File.__table__.c.frames]).limit(1)).first()
+            self._media = True
+          except OperationalError: # no such column
+            self._media = False
+    return self._media
+
   def sets(self):
     """Returns the names of all registered sets"""
 
@@ -125,6 +407,8 @@ class Database(object):
     self.assert_validity()
     VALID_SETS = self.sets()
     sets_ = self.check_validity(sets, "set", VALID_SETS, VALID_SETS)
+    if self.use_snapshot:
+      return self.snapshot().clients_in(sets_)
     # List of the clients
     q = self.session.query(Client).filter(Client.set.in_(sets_)).\
           order_by(Client.id)
@@ -211,6 +495,8 @@ class Database(object):
     """
 
     self.assert_validity()
+    if self.use_snapshot:
+      return list(self.snapshot().protocols)
     return list(self.session.query(Protocol))
 
   def has_protocol(self, name):
@@ -241,6 +527,55 @@ class Database(object):
 
     return ProtocolPurpose.purpose_choices
 
+  def _files(self):
+    """Returns the metadata of all files as a structured array sorted by file
+    identifier, and the matching paths, reading them on first use"""
+
+    self.assert_validity()
+    with self._lock:
+      if self._file_table is None:
+        media = (File.frames, File.file_size) if self.has_media_metadata() else ()
+        rows = self.session.query(File.id, File.client_id, File.session,
+            File.shot, Client.set, File.path, *media).\
+            join(Client).order_by(File.id).all()
+        table = numpy.zeros(len(rows), dtype=FILE_METADATA)
+        for k, row in enumerate(rows):
+          media = [-1 if v is None else v for v in row[6:]] or [-1, -1]
+          table[k] = tuple(row[:5]) + (k,) + tuple(media)
+        self._file_table = (table, tuple(str(row[5]) for row in rows))
+      return self._file_table
+
+  def file_paths(self):
+    """Returns the paths of all files, sorted by file identifier. The
+    ``path_index`` returned by :py:meth:`file_metadata` indexes this tuple."""
+
+    return self._files()[1]
+
+  def file_metadata(self, ids):
+    """Returns the metadata of several files at once.
+
+    Keyword Parameters:
+
+    ids
+    A file identifier or a sequence (or array) of file identifiers
+
+    Returns a structured :py:class:`numpy.ndarray` with one row per
+    identifier, with fields ``id``, ``client_id``, ``session``, ``shot``,
+    ``set`` (the set of the client), ``path_index`` (see
+    :py:meth:`file_paths`), ``frames`` and ``file_size`` (see
+    :py:class:`File`, -1 if unknown). Raises a ValueError listing the identifiers that
+    do not exist.
+    """
+
+    table, paths = self._files()
+    ids = numpy.asarray(ids, dtype=table.dtype['id'])
+    index = numpy.searchsorted(table['id'], ids.ravel()).clip(0, max(len(table) - 1, 0))
+    found = table['id'][index] == ids.ravel() if len(table) else numpy.zeros(ids.size, dtype=bool)
+    if not found.all():
+      unknown = sorted(set(ids.ravel()[~found].tolist()))
+      raise ValueError, "Unknown file identifier(s) %s" % (unknown,)
+    return table[index].reshape(ids.shape)
+
   def fileID_to_clientID(self,id):
     """Returns the client ID of the given file ID"""
     
@@ -288,15 +623,49 @@ class Database(object):
     The classes (types of accesses) to be retrieved ('client', 'impostor')
     or a tuple with several of them. If 'None' is given (this is the
     default), it is considered the same as a tuple with all possible values.
+    When a single class is requested along with probe purposes and client
+    ids, 'client' keeps the files of the given clients only, and 'impostor'
+    the files of the other clients only.
 
-    Returns: A list of files which have the given properties.
+    Returns: A list of files which have the given properties, or a tuple if
+    results are cached (see the ``cache_size`` parameter of the constructor).
     """
 
-    protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
-    purposes = self.check_parameters_for_validity(purposes, "purpose", self.purposes())
-    sets = self.check_parameters_for_validity(sets, "set", self.sets())
-    classes = self.check_parameters_for_validity(classes, "class", ('client', 'impostor'))
-    client_ids = self.check_parameters_for_validity(client_ids, "client_id", range(1,18))
+    if not self.cache_size:
+      return self._objects(protocol, purposes, client_ids, sets, classes)
+
+    def _normalize(parameters):
+      if not parameters: return None
+      if not isinstance(parameters, (list, tuple, set)): return (parameters,)
+      return tuple(sorted(set(parameters)))
+
+    key = tuple(_normalize(k) for k in (protocol, purposes, client_ids, sets, classes))
+    self._check_connection() # not to return the results of a parent process
+    cache = self._caches.objects
+    with self._lock:
+      result = cache.pop(key, None)
+      if result is not None:
+        cache[key] = result # most recently used
+        return result
+
+    result = tuple(self._objects(*key))
+    with self._lock:
+      cache = self._caches.objects # the first query may have (re)connected
+      cache.pop(key, None)
+      while len(cache) >= self.cache_size:
+        cache.popitem(last=False)
+      cache[key] = result
+    return result
+
+  def _objects(self, protocol, purposes, client_ids, sets, classes):
+    """Runs the queries of :py:meth:`objects`, without caching"""
+
+    filter_clients = bool(client_ids) # before the defaults fill them in
+    protocol = self.check_parameters_for_validity(protocol, "protocol", *self._vocabulary('protocol'))
+    purposes = self.check_parameters_for_validity(purposes, "purpose", *self._vocabulary('purpose'))
+    sets = self.check_parameters_for_validity(sets, "set", *self._vocabulary('set'))
+    classes = self.check_parameters_for_validity(classes, "class", *self._vocabulary('class'))
+    client_ids = self.check_parameters_for_validity(client_ids, "client_id", *self._vocabulary('client_id'))
 
     import collections
     if(client_ids is None):
@@ -304,22 +673,243 @@ class Database(object):
     elif(not isinstance(client_ids,collections.Iterable)):
       client_ids = (client_ids,)
 
-    # Now query the database
-    q = self.session.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-            filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.set.in_(sets), ProtocolPurpose.purpose.in_(purposes)))
-            
-    if(('probeMask' in purposes) or ('probeReal' in purposes)):
-        if(classes == 'client'):
-            q = q.filter(Client.id.in_(client_ids))
-        elif(classes == 'impostor'):
+    client_filter = None
+    if filter_clients and len(set(classes)) == 1 and \
+        (('probeMask' in purposes) or ('probeReal' in purposes)):
+      client_filter = ('client' in classes, client_ids)
+
+    if self.use_snapshot:
+      return self.snapshot().objects(protocol, purposes, sets, client_filter)
+
+    # Now query the database: files are selected by identifier among those
+    # associated with the requested protocol purposes, so each comes out once,
+    # and their client and protocol purposes are loaded along, in the same
+    # statement. The flattened membership table answers the selection from
+    # its index alone, when the database has it.
+    if self.has_protocol_file():
+      pf = protocol_file
+      selected = select([pf.c.file_id]).\
+              where(and_(pf.c.protocol.in_(protocol), pf.c.set.in_(sets), pf.c.purpose.in_(purposes)))
+    else:
+      a = protocolPurpose_file_association
+      selected = select([a.c.file_id]).select_from(a.join(ProtocolPurpose).join(Protocol)).\
+              where(and_(Protocol.name.in_(protocol), ProtocolPurpose.set.in_(sets), ProtocolPurpose.purpose.in_(purposes)))
+    q = self.session.query(File).filter(File.id.in_(selected)).\
+            options(joinedload(File.client), joinedload_all(File.protocolPurposes, ProtocolPurpose.protocol))
+    if self.has_media_metadata():
+      q = q.options(undefer_group('media'))
+
+    if client_filter is not None:
+        if client_filter[0]:
+            q = q.filter(File.client_id.in_(client_ids))
+        else:
             q = q.filter(not_(File.client_id.in_(client_ids)))
     
     q = q.order_by(File.client_id, File.session, File.shot)
     
-    # To remove duplicates
-    def removeDup(seq):
-      seen = set()
-      seen_add = seen.add
-      return [ x for x in seq if x not in seen and not seen_add(x)]
-      
-    return removeDup(list(q)) 
+    return list(q)
+
+  def objects_table(self, protocol=None, purposes=None, sets=None):
+    """Returns the protocol to file mapping as a table, for vectorized
+    filtering and grouping.
+
+    Keyword Parameters:
+
+    protocol, purposes, sets
+    As for :py:meth:`objects`.
+
+    Returns a structured :py:class:`numpy.ndarray` with one row per (file,
+    protocol purpose) pair, and fields ``protocol``, ``file_id``,
+    ``client_id``, ``session``, ``shot``, ``set`` (the set of the client),
+    ``purpose`` and ``is_mask`` (if the purpose is about mask attacks). Rows
+    are sorted by protocol, then as :py:meth:`objects` sorts files.
+    """
+
+    self.assert_validity()
+    protocol = self.check_parameters_for_validity(protocol, "protocol", *self._vocabulary('protocol'))
+    purposes = self.check_parameters_for_validity(purposes, "purpose", *self._vocabulary('purpose'))
+    sets = self.check_parameters_for_validity(sets, "set", *self._vocabulary('set'))
+
+    a = protocolPurpose_file_association
+    q = self.session.query(Protocol.name, File.id, File.client_id, File.session,
+          File.shot, Client.set, ProtocolPurpose.purpose).\
+          select_from(a).join(ProtocolPurpose).join(Protocol).join(File).join(Client).\
+          filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.set.in_(sets), ProtocolPurpose.purpose.in_(purposes))).\
+          order_by(Protocol.id, File.client_id, File.session, File.shot, ProtocolPurpose.id)
+
+    rows = q.all()
+    table = numpy.zeros(len(rows), dtype=OBJECTS_TABLE)
+    for k, row in enumerate(rows):
+      table[k] = tuple(row) + (row[-1].endswith('Mask'),)
+    return table
+
+  def load_objects(self, files, directory=None, extension='.hdf5',
+      isdepth=True, iseye=True, workers=4, processes=False, stack=False):
+    """Loads the data of several files concurrently.
+
+    Keyword Parameters:
+
+    files
+    The :py:class:`File` objects to load, as returned by :py:meth:`objects`.
+
+    directory
+    [optional] If not empty or None, this directory is prefixed to the final
+    file destination
+
+    extension
+    [optional] The extension of the filename
+
+    isdepth, iseye
+    [optional] Which streams to load, as in :py:meth:`File.load`
+
+    workers
+    The maximum number of files read at the same time.
+
+    processes
+    If set, reads the files in a pool of processes instead of threads.
+
+    stack
+    If set, the data of all files is copied into preallocated arrays with one
+    more leading dimension indexing the files, instead of being returned as a
+    list. All files must then have the same shapes.
+
+    Returns a list with what :py:meth:`File.load` returns for each file, in the
+    order of ``files``, or the stacked arrays, packed in the same way. If some
+    files cannot be loaded, a :py:class:`xbob.db.maskattack.media.LoadError`
+    reporting each of them is raised once all files have been tried.
+    """
+
+    return media.load_many([f.make_path(directory, extension) for f in files],
+        isdepth, iseye, workers, processes, stack)
+
+  def eye_positions(self, files, directory=None, extension='.hdf5', cache=None):
+    """Reads the eye positions of several files, without touching their video
+    streams.
+
+    Keyword Parameters:
+
+    files
+    The :py:class:`File` objects to consider, as returned by :py:meth:`objects`.
+
+    directory
+    [optional] If not empty or None, this directory is prefixed to the final
+    file destination
+
+    extension
+    [optional] The extension of the filename
+
+    cache
+    [optional] The path to a sidecar ``.npz`` file keeping the positions
+    between calls. Files already found in it, with the same size and
+    modification time, are not read again.
+
+    Returns a tuple (positions, offsets): all eye positions concatenated in a
+    single array (one row per frame), and an array of ``len(files) + 1``
+    offsets, so that the positions of ``files[i]`` are
+    ``positions[offsets[i]:offsets[i+1]]``.
+    """
+
+    return media.eye_positions([f.make_path(directory, extension) for f in files], cache)
+
+  def map(self, fn, files, processes=None, chunksize=1, imap=False, retries=0,
+      directory=None, extension='.hdf5', isdepth=True, iseye=True):
+    """Applies a function to the data of several files, in a pool of
+    processes.
+
+    The files are shipped to the workers as :py:class:`FileDescriptor`
+    objects, loaded there and handed to ``fn``.
+
+    Keyword Parameters:
+
+    fn
+    The function to apply to what :py:meth:`File.load` returns for each file.
+    It must be picklable (i.e., defined at module level).
+
+    files
+    The :py:class:`File` objects to process, as returned by :py:meth:`objects`.
+
+    processes
+    [optional] The number of worker processes. If ``None``, one per CPU.
+
+    chunksize
+    [optional] The number of files sent to a worker at once.
+
+    imap
+    [optional] If set, returns an iterator yielding the results as soon as
+    they are available, instead of a list.
+
+    retries
+    [optional] How many times loading and processing a file is attempted
+    again if it fails. A file still failing after that raises a RuntimeError.
+
+    directory, extension, isdepth, iseye
+    [optional] Passed to :py:meth:`File.load`.
+
+    Returns the results of ``fn``, in the order of ``files``.
+    """
+
+    from multiprocessing import Pool
+
+    load_args = (directory, extension, isdepth, iseye)
+    jobs = [(fn, f.descriptor(), retries, load_args) for f in files]
+
+    pool = Pool(processes)
+    if imap:
+      return _imap(pool, pool.imap(_map_file, jobs, chunksize))
+
+    try:
+      results = pool.map(_map_file, jobs, chunksize)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+    return results
+
+  def iter_loaded(self, files, prefetch=2, directory=None, extension='.hdf5',
+      isdepth=True, iseye=True):
+    """Iterates over the data of several files, loading the next ones in
+    background threads while the current one is being used.
+
+    Keyword Parameters:
+
+    files
+    The :py:class:`File` objects to load, as returned by :py:meth:`objects`.
+
+    prefetch
+    [optional] The number of files loaded ahead of the one being consumed.
+
+    directory, extension, isdepth, iseye
+    [optional] Passed to :py:meth:`File.load`.
+
+    Yields tuples (file, data), where data is what :py:meth:`File.load`
+    returns, in the order of ``files``. Errors loading a file are raised when
+    that file is reached.
+    """
+
+    from collections import deque
+    from multiprocessing.pool import ThreadPool
+
+    if prefetch < 1:
+      raise ValueError("The number of prefetched files must be positive, not %d" % prefetch)
+
+    files = iter(files)
+    pending = deque()
+    pool = ThreadPool(prefetch)
+
+    def _submit():
+      for f in files:
+        pending.append((f, pool.apply_async(f.load,
+          (directory, extension, isdepth, iseye))))
+        return
+
+    try:
+      for k in range(prefetch): _submit()
+      while pending:
+        f, result = pending.popleft()
+        data = result.get()
+        _submit()
+        yield f, data
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
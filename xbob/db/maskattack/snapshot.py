@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""An in-memory snapshot of the 3D mask attack database metadata, answering
+the most common queries without SQL.
+"""
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, undefer_group
+from .models import *
+
+class Snapshot(object):
+  """All clients, files, protocols and protocol purposes of the database,
+  loaded once and indexed in dictionaries.
+
+  The objects held are the ones of the session the snapshot was taken from,
+  with their relationships already loaded, so using them does not issue
+  further queries.
+
+  Keyword parameters:
+
+  session
+    The session to read the database from
+
+  media
+    [optional] If set, the media metadata of the files is loaded as well (see
+    :py:meth:`Database.has_media_metadata`)
+  """
+
+  def __init__(self, session, media=False):
+
+    self.clients = list(session.query(Client).options(joinedload(Client.files)).\
+        order_by(Client.id))
+    """All clients, sorted by identifier"""
+
+    self.protocols = list(session.query(Protocol).\
+        options(joinedload(Protocol.purposes)).order_by(Protocol.id))
+    """All protocols, sorted by identifier"""
+
+    options = [joinedload(File.client), joinedload(File.protocolPurposes)]
+    if media: options.append(undefer_group('media'))
+    self.files = dict((f.id, f) for f in session.query(File).options(*options))
+    """All files, keyed by identifier"""
+
+    # plain copies of what queries sort and filter on, avoiding the (slow)
+    # instrumented attribute access of the ORM objects
+    order = sorted(self.files.values(), key=lambda f: (f.client_id, f.session, f.shot, f.id))
+    self._rank = dict((f.id, k) for k, f in enumerate(order))
+    self._client = dict((f.id, f.client_id) for f in order)
+
+    # file identifiers per (protocol name, set, purpose)
+    purposes = dict((pp.id, (pp.protocol.name, pp.set, pp.purpose))
+        for p in self.protocols for pp in p.purposes)
+    self._members = dict((k, set()) for k in purposes.values())
+    a = protocolPurpose_file_association
+    for purpose_id, file_id in session.execute(select([a.c.protocolPurpose_id, a.c.file_id])):
+      self._members[purposes[purpose_id]].add(file_id)
+
+  def objects(self, protocol, purposes, sets, client_filter=None):
+    """Returns the files of the given protocols, purposes and sets, as
+    :py:meth:`Database.objects` does. The parameters must be validated
+    sequences.
+
+    client_filter
+      [optional] A tuple (include, client_ids): keeps only the files of the
+      given clients if include is set, or of the other clients otherwise
+    """
+
+    ids = set()
+    for key, members in self._members.items():
+      if key[0] in protocol and key[1] in sets and key[2] in purposes:
+        ids |= members
+
+    if client_filter is not None:
+      include, client_ids = client_filter
+      ids = [k for k in ids if (self._client[k] in client_ids) == include]
+
+    return [self.files[k] for k in sorted(ids, key=self._rank.__getitem__)]
+
+  def clients_in(self, sets):
+    """Returns the clients of the given sets, sorted by identifier"""
+
+    return [c for c in self.clients if c.set in sets]
@@ -25,9 +25,83 @@ import unittest
 from .query import Database
 from .models import *
 
+def frame_count(data):
+  """Returns the number of frames of loaded data (used with Database.map)"""
+
+  return len(data[0])
+
+def count_objects(db):
+  """Queries a database in a worker process (used to test fork safety)"""
+
+  return len(db.objects(protocol='verification')), os.getpid()
+
+def write_video(directory, path, frames):
+  """Writes a small synthetic video in the database format"""
+
+  import numpy
+  import h5py
+  color = numpy.random.randint(0, 256, (frames, 3, 6, 8)).astype('uint8')
+  depth = numpy.random.randint(0, 2048, (frames, 6, 8)).astype('uint16')
+  eyes = numpy.random.rand(frames, 4) * 8
+  h = h5py.File(os.path.join(directory, path + '.hdf5'), 'w')
+  h['Color_Data'] = color
+  h['Depth_Data'] = depth
+  h['Eye_Pos'] = eyes
+  h.close()
+  return color, depth, eyes
+
+def baseline_database(source, target):
+  """Copies a database, bringing it back to the schema of the first releases
+  of this package: no indexes, no flattened protocol membership or manifest
+  tables and no media metadata"""
+
+  import shutil, sqlite3
+  shutil.copy(source, target)
+  connection = sqlite3.connect(target)
+  connection.executescript("""
+DROP TABLE IF EXISTS protocol_file;
+DROP TABLE IF EXISTS manifest;
+DROP INDEX IF EXISTS "protocolPurpose_file_purpose_file";
+DROP INDEX IF EXISTS "protocolPurpose_file_file";
+CREATE TABLE baseline_file (id INTEGER NOT NULL, client_id INTEGER,
+  path VARCHAR(100), session INTEGER, shot INTEGER, PRIMARY KEY (id),
+  FOREIGN KEY(client_id) REFERENCES client (id), UNIQUE (path));
+INSERT INTO baseline_file SELECT id, client_id, path, session, shot FROM file;
+DROP TABLE file;
+ALTER TABLE baseline_file RENAME TO file;
+""")
+  connection.close()
+
+def use_database(dbfile):
+  """Points the Database objects created from now on at another database
+  file. Returns the previous one."""
+
+  from . import query
+  previous, query.SQLITE_FILE = query.SQLITE_FILE, dbfile
+  return previous
+
+def create_database(datadir, dbfile, *options):
+  """Runs the create command on the given data directory and database file"""
+
+  import argparse
+  from .create import add_command
+  parser = argparse.ArgumentParser()
+  add_command(parser.add_subparsers())
+  args = parser.parse_args(['create', '-D', datadir] + list(options))
+  args.type, args.files = 'sqlite', [dbfile]
+  return args.func(args)
+
 class MaskAttackDatabaseTest(unittest.TestCase):
   """Performs various tests on the 3d mask attack database."""
 
+  def setUp(self):
+    import tempfile
+    self.tmpdir = tempfile.mkdtemp() # a scratch directory, removed after each test
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.tmpdir)
+
   def test01_queryVerificationProtocol(self):
   
     db = Database()
@@ -115,3 +189,679 @@ class MaskAttackDatabaseTest(unittest.TestCase):
     from bob.db.script.dbmanage import main
 
     self.assertEqual(main('maskattack checkfiles --self-test'.split()), 0)
+
+  def test08_lazyVideo(self):
+
+    tmpdir = self.tmpdir
+    color, depth, eyes = write_video(tmpdir, '01_01_01', 10)
+    f = File(1, '01_01_01', 1, 1)
+    with f.open(tmpdir) as v:
+      self.assertEqual(len(v), 10)
+      c, d, e = v[2:5]
+      self.assertTrue((c == color[2:5]).all())
+      self.assertTrue((d == depth[2:5]).all())
+      self.assertTrue((e == eyes[2:5]).all())
+      c, d, e = v[[7, 1, 7]]
+      self.assertTrue((c == color[[7, 1, 7]]).all())
+      c, d, e = v[::-3]
+      self.assertTrue((e == eyes[::-3]).all())
+    with f.open(tmpdir, isdepth=False, iseye=False) as v:
+      self.assertTrue((v[4] == color[4]).all())
+    windows = list(f.iter_frames(4, tmpdir, isdepth=False))
+    self.assertEqual([len(c) for c, e in windows], [4, 4, 2])
+    self.assertTrue((windows[2][1] == eyes[8:]).all())
+
+  def test09_loadObjects(self):
+
+    from .media import LoadError
+    tmpdir = self.tmpdir
+    files = [File(1, '01_01_%02d' % k, 1, k) for k in range(1, 6)]
+    data = [write_video(tmpdir, f.path, 4) for f in files]
+    db = Database()
+    r = db.load_objects(files, tmpdir, workers=2)
+    self.assertEqual(len(r), 5)
+    for (c, d, e), (c_, d_, e_) in zip(r, data):
+      self.assertTrue((c == c_).all() and (d == d_).all() and (e == e_).all())
+    c, e = db.load_objects(files, tmpdir, isdepth=False, stack=True)
+    self.assertEqual(c.shape, (5, 4, 3, 6, 8))
+    self.assertTrue((e[3] == data[3][2]).all())
+    missing = files + [File(1, '01_01_09', 1, 9)]
+    self.assertRaises(LoadError, db.load_objects, missing, tmpdir)
+    # a missing first file is reported as any other, while stacking
+    missing = [File(1, '01_01_09', 1, 9)] + files
+    try:
+      db.load_objects(missing, tmpdir, isdepth=False, stack=True)
+      self.fail("LoadError not raised")
+    except LoadError as e:
+      self.assertEqual([k[0] for k in e.failures], [missing[0].make_path(tmpdir)])
+      c, e = e.results
+      self.assertEqual(c.shape, (6, 4, 3, 6, 8))
+      self.assertTrue((e[4] == data[3][2]).all())
+    try:
+      db.load_objects(missing[:1], tmpdir, stack=True)
+      self.fail("LoadError not raised")
+    except LoadError as e:
+      self.assertEqual((len(e.failures), e.results), (1, None))
+
+  def test10_npyConvert(self):
+
+    import numpy
+    from . import media
+    tmpdir = self.tmpdir
+    color, depth, eyes = write_video(tmpdir, '01_01_01', 10)
+    f = File(1, '01_01_01', 1, 1)
+    media.convert(f.make_path(tmpdir), f.make_path(tmpdir, '.npy'), chunk=3)
+    c, d, e = f.load(tmpdir, '.npy')
+    self.assertTrue(isinstance(c, numpy.memmap))
+    self.assertFalse(c.flags.writeable)
+    self.assertTrue((c == color).all() and (d == depth).all() and (e == eyes).all())
+    with f.open(tmpdir, '.npy', isdepth=False) as v:
+      c, e = v[[5, 2]]
+      self.assertTrue((c == color[[5, 2]]).all())
+
+  def test11_loadCache(self):
+
+    from .media import LoadCache
+    tmpdir = self.tmpdir
+    try:
+      files = [File(1, '01_01_%02d' % k, 1, k) for k in range(1, 4)]
+      for f in files: write_video(tmpdir, f.path, 4)
+      # 4 frames of 3x6x8 bytes each: room for two color streams only
+      File.cache = LoadCache(2*4*3*6*8)
+      c = files[0].load(tmpdir, isdepth=False, iseye=False)
+      self.assertTrue(files[0].load(tmpdir, isdepth=False, iseye=False) is c)
+      self.assertFalse(c.flags.writeable)
+      self.assertEqual((File.cache.hits, File.cache.misses), (1, 1))
+      files[1].load(tmpdir, isdepth=False, iseye=False)
+      files[2].load(tmpdir, isdepth=False, iseye=False)
+      self.assertEqual(len(File.cache), 2)
+      self.assertFalse(files[0].load(tmpdir, isdepth=False, iseye=False) is c)
+      self.assertEqual(File.cache.misses, 4)
+      # too large for the budget
+      write_video(tmpdir, '01_01_04', 10)
+      File(1, '01_01_04', 1, 4).load(tmpdir, isdepth=False, iseye=False)
+      self.assertEqual(File.cache.nbytes, 2*4*3*6*8)
+    finally:
+      File.cache = None
+
+  def test12_selectiveLoad(self):
+
+    import numpy
+    from .media import face_box
+    tmpdir = self.tmpdir
+    color, depth, eyes = write_video(tmpdir, '01_01_01', 10)
+    f = File(1, '01_01_01', 1, 1)
+    c, d, e = f.load(tmpdir, frames=[8, 3], roi=(1, 2, 3, 4))
+    self.assertTrue((c == color[[8, 3], :, 1:4, 2:6]).all())
+    self.assertTrue((d == depth[[8, 3], 1:4, 2:6]).all())
+    self.assertTrue((e == eyes[[8, 3]]).all())
+    c = f.load(tmpdir, isdepth=False, iseye=False, frames=slice(2, 6), roi='face')
+    top, left, height, width = face_box(eyes[2:6], 6, 8)
+    self.assertTrue((c == color[2:6, :, top:top+height, left:left+width]).all())
+    self.assertEqual(face_box([[2., 2., 4., 2.]], 6, 8), (0, 1, 5, 4))
+    self.assertRaises(ValueError, face_box, numpy.zeros((3, 4)), 6, 8)
+
+  def test13_eyePositions(self):
+
+    tmpdir = self.tmpdir
+    files = [File(1, '01_01_%02d' % k, 1, k) for k in range(1, 4)]
+    eyes = [write_video(tmpdir, f.path, 3 + k)[2] for k, f in enumerate(files)]
+    db = Database()
+    cache = os.path.join(tmpdir, 'eyes.npz')
+    positions, offsets = db.eye_positions(files[:2], tmpdir, cache=cache)
+    self.assertEqual(list(offsets), [0, 3, 7])
+    self.assertTrue((positions[3:7] == eyes[1]).all())
+    # served from the sidecar when unchanged
+    from . import media
+    loaded = []
+    load_eyes = media.load_eyes
+    media.load_eyes = lambda filename: loaded.append(filename) or load_eyes(filename)
+    try:
+      positions, offsets = db.eye_positions(files[::-1], tmpdir, cache=cache)
+      self.assertEqual(list(offsets), [0, 5, 9, 12])
+      self.assertTrue((positions[9:] == eyes[0]).all())
+      self.assertEqual(loaded, [files[2].make_path(tmpdir)])
+      # but read again once changed
+      del loaded[:]
+      eyes[0] = write_video(tmpdir, files[0].path, 6)[2]
+      stat = os.stat(files[0].make_path(tmpdir))
+      os.utime(files[0].make_path(tmpdir), (stat.st_atime, stat.st_mtime + 10))
+      positions, offsets = db.eye_positions(files[:1], tmpdir, cache=cache)
+      self.assertTrue((positions == eyes[0]).all())
+      self.assertEqual(loaded, [files[0].make_path(tmpdir)])
+      # and files of another directory are not mistaken for these
+      other = os.path.join(tmpdir, 'other')
+      os.mkdir(other)
+      moved = write_video(other, files[1].path, 2)[2]
+      positions, offsets = db.eye_positions(files[1:2], other, cache=cache)
+      self.assertTrue((positions == moved).all())
+    finally:
+      media.load_eyes = load_eyes
+
+  def test14_map(self):
+
+    import pickle
+    tmpdir = self.tmpdir
+    db = Database()
+    files = db.objects(protocol='classification', sets='dev')[:4]
+    for k, f in enumerate(files): write_video(tmpdir, f.path, 2 + k)
+    d = pickle.loads(pickle.dumps(files[1].descriptor()))
+    self.assertEqual((d.id, d.path), (files[1].id, files[1].path))
+    self.assertEqual(len(d.load(tmpdir)[0]), 3)
+    self.assertEqual(db.map(frame_count, files, 2, directory=tmpdir), [2, 3, 4, 5])
+    self.assertEqual(list(db.map(frame_count, files, 2, imap=True, directory=tmpdir)), [2, 3, 4, 5])
+    os.unlink(files[2].make_path(tmpdir))
+    self.assertRaises(RuntimeError, db.map, frame_count, files, 2, retries=1, directory=tmpdir)
+
+  def test15_iterLoaded(self):
+
+    tmpdir = self.tmpdir
+    files = [File(1, '01_01_%02d' % k, 1, k) for k in range(1, 6)]
+    data = [write_video(tmpdir, f.path, k + 1) for k, f in enumerate(files)]
+    db = Database()
+    loaded = list(db.iter_loaded(files, 2, tmpdir))
+    self.assertEqual([f for f, d in loaded], files)
+    for (f, (c, d, e)), (c_, d_, e_) in zip(loaded, data):
+      self.assertTrue((c == c_).all() and (d == d_).all() and (e == e_).all())
+
+  def test16_snapshot(self):
+
+    db = Database()
+    mem = Database(snapshot=True)
+    self.assertEqual([c.id for c in mem.clients(sets='dev')], [c.id for c in db.clients(sets='dev')])
+    self.assertEqual(mem.protocol_names(), db.protocol_names())
+    for protocol in (None, 'verification', 'classification'):
+      for sets in (None, 'world', 'dev', 'test'):
+        for purposes in (None, 'enrol', 'probeMask', 'classifyReal', ('trainReal', 'trainMask')):
+          self.assertEqual(
+              [f.id for f in mem.objects(protocol=protocol, sets=sets, purposes=purposes)],
+              [f.id for f in db.objects(protocol=protocol, sets=sets, purposes=purposes)])
+
+  def test17_objectsCache(self):
+
+    db = Database(cache_size=2)
+    f = db.objects(protocol='verification', sets=['test', 'dev'])
+    self.assertTrue(isinstance(f, tuple))
+    self.assertEqual(len(f), 150)
+    self.assertTrue(db.objects(protocol=('verification',), sets=('dev', 'test')) is f)
+    db.objects(protocol='classification')
+    db.objects(protocol='classification', sets='world')
+    self.assertFalse(db.objects(protocol='verification', sets=['test', 'dev']) is f)
+    self.assertRaises(ValueError, db.objects, protocol='unknown')
+    g = db.objects(protocol='classification')
+    db.connect()
+    self.assertFalse(db.objects(protocol='classification') is g)
+    self.assertRaises(ValueError, Database, cache_size=-1)
+
+  def test18_objectsStatementCount(self):
+
+    from sqlalchemy import event
+    db = Database()
+    statements = []
+    def count(*args): statements.append(args[2])
+    event.listen(db.session.bind, 'before_cursor_execute', count)
+
+    def walk(**kwargs):
+      del statements[:]
+      files = db.objects(**kwargs)
+      for f in files:
+        f.client.set
+        [(p.protocol.name, p.purpose) for p in f.protocolPurposes]
+      return len(files), len(statements)
+
+    nfiles, nstatements = walk(protocol='classification')
+    self.assertEqual(nfiles, 255)
+    # the valid protocols and clients, whether the membership table is filled
+    # and whether the media metadata is there (once), then the files with
+    # their clients and protocol purposes
+    self.assertEqual(nstatements, 5)
+    self.assertEqual(walk(protocol='verification', sets='dev'), (75, 1))
+
+  def test19_fileMetadata(self):
+
+    db = Database()
+    files = db.objects(protocol='classification', sets='test')[::7]
+    m = db.file_metadata([f.id for f in files])
+    self.assertEqual(list(m['client_id']), [f.client_id for f in files])
+    self.assertEqual(list(m['session']), [f.session for f in files])
+    self.assertEqual(list(m['shot']), [f.shot for f in files])
+    self.assertEqual(set(m['set']), set(['test']))
+    self.assertEqual([db.file_paths()[k] for k in m['path_index']], [f.path for f in files])
+    self.assertEqual(db.file_metadata(files[0].id)['shot'], files[0].shot)
+    self.assertRaises(ValueError, db.file_metadata, [files[0].id, 100000])
+
+  def test20_objectsTable(self):
+
+    import numpy
+    db = Database()
+    t = db.objects_table(protocol='verification')
+    self.assertEqual(len(numpy.unique(t['file_id'])), 220)
+    dev = t[t['set'] == 'dev']
+    self.assertEqual(len(dev), 75)
+    self.assertEqual(int(dev['is_mask'].sum()), 25)
+    self.assertTrue((dev['session'][dev['purpose'] == 'probeMask'] == 3).all())
+    t = db.objects_table(sets='world', purposes='trainMask')
+    self.assertEqual(len(t), 35)
+    self.assertTrue(t['is_mask'].all())
+
+  def test21_managerStartup(self):
+
+    # building the command line of bob_dbmanage.py must not connect to the
+    # database, as it happens on every invocation, whatever the database or
+    # the subcommand; importing this package and building its commands is
+    # timed against importing the dependencies it cannot do without, and
+    # must cost less than those, leaving h5py and multiprocessing out
+    import subprocess
+    code = """
+import sys, time, argparse
+from sqlite3 import dbapi2
+connections = []
+connect = dbapi2.connect
+dbapi2.connect = lambda *args, **kwargs: connections.append(args) or connect(*args, **kwargs)
+start = time.time()
+import pkg_resources, numpy, sqlalchemy.orm, sqlalchemy.ext.declarative
+import bob.db.driver, bob.db.utils, bob.db.sqlalchemy_migration
+baseline = time.time() - start
+loaded = set(sys.modules)
+start = time.time()
+import xbob.db.maskattack
+from xbob.db.maskattack.driver import Interface
+Interface().add_commands(argparse.ArgumentParser().add_subparsers())
+elapsed = time.time() - start
+heavy = [k for k in ('h5py', 'multiprocessing') if k in sys.modules and k not in loaded]
+sys.stdout.write('%d %d %f %f' % (len(connections), len(heavy), baseline, elapsed))
+"""
+    out = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE).communicate()[0]
+    connections, heavy, baseline, elapsed = out.split()
+    self.assertEqual(int(connections), 0)
+    self.assertEqual(int(heavy), 0)
+    self.assertTrue(float(elapsed) < float(baseline),
+        "importing the package took %s seconds, its dependencies %s" % (elapsed, baseline))
+
+  def test22_readOnly(self):
+
+    from sqlalchemy.exc import OperationalError
+    db = Database(read_only=True)
+    self.assertEqual(len(db.objects(protocol='verification')), 220)
+    other = Database(read_only=True)
+    self.assertEqual(len(other.clients()), 17)
+    self.assertTrue(db.session.bind is other.session.bind)
+    self.assertRaises(OperationalError, db.session.execute, "CREATE TABLE test (id INTEGER)")
+
+    # reading takes no lock, so it goes on while another process writes
+    import sqlite3
+    from . import query
+    writer = sqlite3.connect(query.SQLITE_FILE, timeout=0)
+    try:
+      writer.execute('BEGIN EXCLUSIVE')
+      self.assertEqual(len(Database(read_only=True).objects(protocol='classification')), 255)
+      locking = sqlite3.connect(query.SQLITE_FILE, timeout=0)
+      self.assertRaises(sqlite3.OperationalError, locking.execute, 'SELECT COUNT(*) FROM file')
+      locking.close()
+    finally:
+      writer.rollback()
+      writer.close()
+
+    # without URI filenames, SQLite would lock: refuse rather than degrade
+    if sys.version_info < (3, 4):
+      uses_uri = query._sqlite_uses_uri
+      query._sqlite_uses_uri = lambda: False
+      try:
+        self.assertRaises(RuntimeError, query._connect_read_only)
+      finally:
+        query._sqlite_uses_uri = uses_uri
+
+  def test23_threadSafe(self):
+
+    import threading
+    from sqlalchemy.orm import object_session
+    for kwargs in (dict(thread_safe=True), dict(thread_safe=True, read_only=True, cache_size=4),
+        dict(thread_safe=True, snapshot=True)):
+      db = Database(**kwargs)
+      errors = []
+      counts = []
+      def query():
+        try:
+          for k in range(10):
+            counts.append(len(db.objects(protocol='verification', sets='dev')))
+            files = db.objects(protocol='classification', purposes='trainMask')
+            counts.append(len(files))
+            # the objects handed out belong to the session of this thread
+            if object_session(files[0]) is not db.session():
+              errors.append('%s shared with another thread' % files[0])
+            files[0].protocolPurposes[0].files
+        except Exception as e:
+          errors.append(e)
+      threads = [threading.Thread(target=query) for k in range(16)]
+      for t in threads: t.start()
+      for t in threads: t.join()
+      self.assertEqual(errors, [])
+      self.assertEqual(sorted(set(counts)), [35, 75])
+      self.assertEqual(len(counts), 16 * 20)
+
+  def test24_forkAndPickle(self):
+
+    import pickle
+    import numpy
+    from multiprocessing import Pool
+    from sqlalchemy.orm import object_session
+    db = Database(cache_size=4)
+    self.assertEqual(len(db.objects(protocol='verification')), 220)
+    session = db.session
+
+    # a forked child re-opens its own connection on first use, and does not
+    # get the objects its parent cached, bound to the inherited session
+    pid = os.fork()
+    if pid == 0:
+      f = db.objects(protocol='verification')
+      ok = len(f) == 220 and object_session(f[0]) is db.session and \
+          db.session is not session and len(db.objects(protocol='classification')) == 255
+      os._exit(0 if ok else 1)
+    self.assertEqual(os.waitpid(pid, 0)[1], 0)
+    self.assertTrue(db.session is session)
+
+    # pickled databases only carry their parameters
+    copy = pickle.loads(pickle.dumps(db))
+    self.assertEqual((copy.cache_size, copy.read_only), (4, False))
+    # without seeding the random number generator of the process again
+    data = pickle.dumps(db)
+    draws = []
+    for k in range(2):
+      pickle.loads(data)
+      draws.append(numpy.random.rand())
+    self.assertNotEqual(draws[0], draws[1])
+    self.assertEqual(len(copy.clients()), 17)
+    pool = Pool(2)
+    try:
+      results = pool.map(count_objects, [db] * 4)
+    finally:
+      pool.close()
+      pool.join()
+    self.assertEqual(set(k[0] for k in results), set([220]))
+    self.assertFalse(os.getpid() in [k[1] for k in results])
+
+  def test25_validation(self):
+
+    from sqlalchemy import event
+    db = Database()
+    statements = []
+    def count(*args): statements.append(args[2])
+    event.listen(db.session.bind, 'before_cursor_execute', count)
+    db.objects(protocol='verification', client_ids=[3, 17])
+    self.assertRaises(ValueError, db.objects, client_ids=18)
+    self.assertRaises(ValueError, db.objects, protocol='unknown')
+    self.assertRaises(ValueError, db.objects, purposes='train')
+    del statements[:]
+    db.objects(protocol='verification', sets='dev')
+    # only the query for the files, validation reads nothing
+    self.assertEqual(len(statements), 1)
+
+
+  def test26_protocolFile(self):
+
+    from . import query
+    db = Database()
+    self.assertTrue(db.has_protocol_file())
+    queries = (dict(), dict(protocol='verification', sets='dev'),
+        dict(protocol='classification', purposes=('trainMask', 'classifyMask')),
+        dict(purposes='probeReal', sets='test'))
+    expected = [[f.id for f in db.objects(**kwargs)] for kwargs in queries]
+
+    # a database without the flattened table is queried through the joins
+    previous = use_database(os.path.join(self.tmpdir, 'db.sql3'))
+    try:
+      baseline_database(previous, query.SQLITE_FILE)
+      joined = Database()
+      self.assertFalse(joined.has_protocol_file())
+      self.assertEqual(expected,
+          [[f.id for f in joined.objects(**kwargs)] for kwargs in queries])
+      self.assertFalse(joined.has_protocol_file())
+    finally:
+      use_database(previous)
+
+  def test27_createBenchmark(self):
+
+    import time, sqlite3
+    # 10k files by default, set MASKATTACK_BENCHMARK_FILES for larger runs
+    nfiles = int(os.environ.get('MASKATTACK_BENCHMARK_FILES', 10000))
+    shots = -(-nfiles // (17 * 3))
+    tmpdir = self.tmpdir
+    datadir = os.path.join(tmpdir, 'data')
+    os.mkdir(datadir)
+    for client in range(1, 18):
+      for session in range(1, 4):
+        for shot in range(1, shots + 1):
+          open(os.path.join(datadir, '%02d_%02d_%03d.hdf5' % (client, session, shot)), 'w').close()
+    dbfile = os.path.join(tmpdir, 'db.sql3')
+    start = time.time()
+    self.assertEqual(create_database(datadir, dbfile, '--no-validate'), 0)
+    elapsed = time.time() - start
+    sys.stderr.write("\ncreate: %d files in %.2f s\n" % (17 * 3 * shots, elapsed))
+
+    connection = sqlite3.connect(dbfile)
+    count = lambda table: connection.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+    self.assertEqual(count('file'), 17 * 3 * shots)
+    # verification leaves the mask attacks of the world set out (7 clients)
+    associations = 2 * 17 * 3 * shots - 7 * shots
+    self.assertEqual(count('protocolPurpose_file_association'), associations)
+    self.assertEqual(count('protocol_file'), associations)
+    connection.close()
+
+  def test28_createValidation(self):
+
+    import sqlite3
+    import h5py
+    tmpdir = self.tmpdir
+    for path in ('01_01_01', '01_01_02', '08_02_01'):
+      write_video(tmpdir, path, 3)
+    # truncated
+    data = open(os.path.join(tmpdir, '01_01_01.hdf5'), 'rb').read()
+    open(os.path.join(tmpdir, '01_01_03.hdf5'), 'wb').write(data[:len(data) // 2])
+    # missing stream
+    write_video(tmpdir, '13_03_01', 3)
+    h = h5py.File(os.path.join(tmpdir, '13_03_01.hdf5'), 'a')
+    del h['Eye_Pos']
+    h.close()
+    # inconsistent frame counts
+    write_video(tmpdir, '13_03_02', 3)
+    h = h5py.File(os.path.join(tmpdir, '13_03_02.hdf5'), 'a')
+    del h['Eye_Pos']
+    h['Eye_Pos'] = [[0., 0., 0., 0.]] * 2
+    h.close()
+
+    from .create import check_files, scan
+    names = [k[0] for k in scan(tmpdir)]
+    self.assertEqual(len(names), 6)
+    good, bad = check_files(tmpdir, names, jobs=2)
+    self.assertEqual([k[0] for k in good], ['01_01_01.hdf5', '01_01_02.hdf5', '08_02_01.hdf5'])
+    self.assertEqual([k[0] for k in bad], ['01_01_03.hdf5', '13_03_01.hdf5', '13_03_02.hdf5'])
+    self.assertTrue('Eye_Pos' in bad[1][1])
+    self.assertEqual(check_files(tmpdir, names, jobs=1), (good, bad))
+
+    dbfile = os.path.join(tmpdir, 'db.sql3')
+    self.assertEqual(create_database(tmpdir, dbfile, '-j', '2'), 0)
+    connection = sqlite3.connect(dbfile)
+    paths = [k for (k,) in connection.execute('SELECT path FROM file ORDER BY id')]
+    connection.close()
+    self.assertEqual(paths, ['01_01_01', '01_01_02', '08_02_01'])
+
+  def test29_createUpdate(self):
+
+    import sqlite3
+    tmpdir = self.tmpdir
+    datadir = os.path.join(tmpdir, 'data')
+    os.mkdir(datadir)
+    for path in ('01_01_01', '01_01_02', '08_02_01', '13_03_01'):
+      write_video(datadir, path, 3)
+
+    def contents(dbfile):
+      connection = sqlite3.connect(dbfile)
+      files = dict(connection.execute('SELECT path, id FROM file'))
+      memberships = sorted(connection.execute('SELECT protocol, "set", purpose, path '
+        'FROM protocol_file JOIN file ON file.id = file_id'))
+      associations = sorted(connection.execute('SELECT protocolPurpose_id, path '
+        'FROM protocolPurpose_file_association JOIN file ON file.id = file_id'))
+      stats = dict((k[0], k[1:]) for k in connection.execute('SELECT path, size, mtime FROM manifest'))
+      connection.close()
+      return files, memberships, associations, stats
+
+    # an update of a missing database creates it
+    dbfile = os.path.join(tmpdir, 'db.sql3')
+    self.assertEqual(create_database(datadir, dbfile, '-U', '-j', '1'), 0)
+    before = contents(dbfile)
+    self.assertEqual(sorted(before[0]), ['01_01_01', '01_01_02', '08_02_01', '13_03_01'])
+
+    write_video(datadir, '08_02_02', 3)
+    os.unlink(os.path.join(datadir, '01_01_02.hdf5'))
+    write_video(datadir, '13_03_01', 5)
+    stat = os.stat(os.path.join(datadir, '13_03_01.hdf5'))
+    os.utime(os.path.join(datadir, '13_03_01.hdf5'), (stat.st_atime, stat.st_mtime + 10))
+
+    self.assertEqual(create_database(datadir, dbfile, '-U', '-j', '1'), 0)
+    after = contents(dbfile)
+    # untouched files keep their identifiers
+    self.assertEqual(after[0]['01_01_01'], before[0]['01_01_01'])
+    self.assertEqual(after[0]['13_03_01'], before[0]['13_03_01'])
+    self.assertEqual(sorted(after[0]), ['01_01_01', '08_02_01', '08_02_02', '13_03_01'])
+    # the manifest matches the data directory exactly, so a further update
+    # finds nothing to do
+    from .create import scan
+    self.assertEqual(after[3], dict((os.path.splitext(k[0])[0], k[1:]) for k in scan(datadir)))
+    self.assertTrue(after[3]['13_03_01'][1] > before[3]['13_03_01'][1])
+
+    # the same as creating the database again
+    fresh = os.path.join(tmpdir, 'fresh.sql3')
+    self.assertEqual(create_database(datadir, fresh, '-j', '1'), 0)
+    expected = contents(fresh)
+    self.assertEqual(after[1], expected[1])
+    self.assertEqual(after[2], expected[2])
+    self.assertEqual(after[3], expected[3])
+
+  def test30_mediaMetadata(self):
+
+    import pickle
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker, undefer_group
+    tmpdir = self.tmpdir
+    datadir = os.path.join(tmpdir, 'data')
+    os.mkdir(datadir)
+    write_video(datadir, '01_01_01', 3)
+    write_video(datadir, '08_02_01', 5)
+    dbfile = os.path.join(tmpdir, 'db.sql3')
+
+    def files():
+      engine = create_engine('sqlite:///' + dbfile)
+      session = sessionmaker(bind=engine)()
+      result = [f.descriptor() for f in session.query(File).options(undefer_group('media')).order_by(File.path)]
+      session.close()
+      engine.dispose()
+      return result
+
+    # unchecked files only have their size
+    self.assertEqual(create_database(datadir, dbfile, '--no-validate'), 0)
+    f = files()[0]
+    self.assertEqual((f.frames, f.color_shape, f.depth_shape, f.nbytes), (None,) * 4)
+    self.assertEqual(f.file_size, os.path.getsize(os.path.join(datadir, '01_01_01.hdf5')))
+
+    # an update checks them, filling the rest in
+    self.assertEqual(create_database(datadir, dbfile, '-U', '-j', '1'), 0)
+    f, g = files()
+    self.assertEqual(f.frames, 3)
+    self.assertEqual(f.color_shape, (3, 3, 6, 8))
+    self.assertEqual(g.depth_shape, (5, 6, 8))
+    self.assertEqual((f.color_dtype, f.depth_dtype), ('uint8', 'uint16'))
+    self.assertEqual(g.nbytes, 5 * 3 * 6 * 8 + 5 * 6 * 8 * 2)
+    self.assertEqual(g.nbytes, sum(k.nbytes for k in g.load(datadir, isdepth=True, iseye=False)))
+    g = pickle.loads(pickle.dumps(g))
+    self.assertEqual(g.color_shape, (5, 3, 6, 8))
+
+    db = Database()
+    files = db.objects(protocol='verification', sets='dev')
+    self.assertTrue(db.has_media_metadata())
+    self.assertTrue(min(f.frames for f in files) > 0)
+    m = db.file_metadata([f.id for f in files])
+    self.assertEqual(list(m['frames']), [f.frames for f in files])
+    self.assertEqual(list(m['file_size']), [f.file_size for f in files])
+    self.assertEqual(files[0].descriptor().frames, files[0].frames)
+
+    # databases created before the media metadata are still queried
+    from . import query
+    previous = use_database(os.path.join(self.tmpdir, 'baseline.sql3'))
+    try:
+      baseline_database(previous, query.SQLITE_FILE)
+      for kwargs in (dict(), dict(snapshot=True)):
+        db = Database(**kwargs)
+        files = db.objects(protocol='verification', sets='dev')
+        self.assertEqual(len(files), 75)
+        self.assertFalse(db.has_media_metadata())
+        self.assertEqual(files[0].descriptor().frames, None)
+        m = db.file_metadata([f.id for f in files])
+        self.assertEqual(set(m['frames']), set([-1]))
+    finally:
+      use_database(previous)
+
+  def test31_updateBaseline(self):
+
+    import sqlite3
+    from sqlalchemy.engine.reflection import Inspector
+    from .models import Base
+    tmpdir = self.tmpdir
+    datadir = os.path.join(tmpdir, 'data')
+    os.mkdir(datadir)
+    for path in ('01_01_01', '01_02_01', '08_01_01', '13_03_01'):
+      write_video(datadir, path, 3)
+    dbfile = os.path.join(tmpdir, 'db.sql3')
+    self.assertEqual(create_database(datadir, dbfile, '-j', '1'), 0)
+    baseline = os.path.join(tmpdir, 'baseline.sql3')
+    baseline_database(dbfile, baseline)
+
+    # adding a file to a database of the first releases keeps the others
+    write_video(datadir, '08_02_01', 3)
+    self.assertEqual(create_database(datadir, baseline, '-U', '-j', '1'), 0)
+    self.assertEqual(create_database(datadir, dbfile, '-R', '-j', '1'), 0)
+    connection = sqlite3.connect(baseline)
+    self.assertEqual(connection.execute('SELECT COUNT(*) FROM file').fetchone()[0], 5)
+    connection.close()
+
+    queries = (dict(), dict(protocol='verification'), dict(protocol='classification'),
+        dict(protocol='verification', sets='dev'),
+        dict(purposes='probeReal', client_ids=1, classes='impostor'))
+    previous = use_database(dbfile)
+    try:
+      db = Database()
+      expected = [[f.path for f in db.objects(**kwargs)] for kwargs in queries]
+      use_database(baseline)
+      db = Database()
+      self.assertTrue(db.has_protocol_file())
+      self.assertEqual(expected, [[f.path for f in db.objects(**kwargs)] for kwargs in queries])
+      self.assertEqual(len(db.objects()), 5)
+    finally:
+      use_database(previous)
+
+    # with the indexes added since
+    from bob.db.utils import create_engine_try_nolock
+    engine = create_engine_try_nolock('sqlite', baseline)
+    inspector = Inspector.from_engine(engine)
+    for table in Base.metadata.sorted_tables:
+      self.assertTrue(set(k.name for k in table.indexes) <=
+          set(k['name'] for k in inspector.get_indexes(table.name)))
+    engine.dispose()
+
+  def test32_objectsClasses(self):
+
+    db = Database()
+    mem = Database(snapshot=True)
+    probes = db.objects(protocol='verification', sets='dev', purposes='probeReal')
+    model = db.clients(sets='dev')[0].id
+    for backend in (db, mem):
+      query = lambda classes: backend.objects(protocol='verification', sets='dev',
+          purposes='probeReal', client_ids=model, classes=classes)
+      clients, impostors = query('client'), query('impostor')
+      self.assertTrue(clients and impostors)
+      self.assertEqual(set(f.client_id for f in clients), set([model]))
+      self.assertFalse(model in [f.client_id for f in impostors])
+      self.assertEqual(sorted(f.id for f in clients + impostors), sorted(f.id for f in probes))
+      # without client ids, or for both classes, nothing is filtered
+      self.assertEqual(len(query(('client', 'impostor'))), len(probes))
+      self.assertEqual(len(backend.objects(protocol='verification', sets='dev',
+          purposes='probeReal', classes='impostor')), len(probes))